@@ -22,15 +22,28 @@ This was so the terminology in the documentation for the cpi matches with the na
 
 """
 from pcaspy import Driver, SimpleServer, cas
-import time, threading, os, os.path, pickle, socket, platform, sys
-from PyDAQmx import *
-from epics import *
+from pcaspy.tools import ServerThread
+import time, threading, os, os.path, socket, platform, sys, argparse, re
+# --sim replaces the NI-DAQ and EPICS with the simulated DAQ, PVs and CPI model in syncSim (must be known before the import)
+SIM = '--sim' in sys.argv
+if SIM:
+    from syncSim import *
+else:
+    from PyDAQmx import *
+    from epics import *
 import numpy as np
 from datetime import datetime, timedelta
-import psutil, gc
+import psutil, gc, signal
 from multiprocessing import Process
 sys.path.append(os.path.realpath('../utils'))
 import epicsApps
+from syncDaq import OutputWorker, PortShadow, LineState
+from syncTiming import LogHistogram, LoopProfiler
+from syncJobs import JobQueue, TimerWheel
+from syncEpics import PVS
+from syncEvents import EdgeLog
+from syncClock import monotonic, calibrate
+from syncLog import LOG, LEVEL_NAMES
 
 EXPERIMENT          = 'CEL:'
 DAQ_NAME            = 'cmp200Sync'
@@ -41,17 +54,41 @@ CPI_LED_IN          = DAQ_NAME + '/port0/line0'             # turns the led in t
 CPI_EXPOSE_OK_IN    = DAQ_NAME + '/port0/line1'             # this line will always be set high for exposure
 CPI_EXPOSE_IN       = DAQ_NAME + '/port0/line2'             # setting high allows exposure
 CPI_RAD_PREP_IN     = DAQ_NAME + '/port0/line6'             # setting high enables rad prep
+# Drive all the output lines from one port level task (one USB transaction no matter how many lines change)
+# instead of one task per line
+PORT_OUTPUT         = False
+OUTPUT_LINES        = [CPI_EXPOSE_OK_IN, CPI_EXPOSE_IN, CPI_RAD_PREP_IN]
 # These are the DAQ inputs (output from CPI)
 CPI_RAD_PREP_OUT    = DAQ_NAME  + '/port1/line0'
 CPI_RAD_READY_OUT   = DAQ_NAME  + '/port1/line1'
 CPI_EXPOSE_OUT      = DAQ_NAME  + '/port1/line2'
 # These are the lines that will be polled for change detection
 INPUT_POLL= CPI_RAD_PREP_OUT + "," + CPI_RAD_READY_OUT + "," + CPI_EXPOSE_OUT
-SCAN_CANCEL_IOC     = PV(SCAN_IOC + 'AbortScans.PROC', callback = True)
+# pcas records for each polled line (same order as INPUT_POLL)
+INPUT_RECORDS = ('RAD_PREP_RBV', 'RAD_READY_RBV', 'EXPOSE_RBV')
+# bit weights used to pack the polled lines into one word for change detection
+INPUT_BITS = 1 << np.arange(len(INPUT_RECORDS))
+# How input edges are detected: 'poll' (usb-6501, no hardware change detection) or 'change'
+# (DAQmx change detection callbacks, e.g. usb-6525). Can be overridden with --input at startup
+INPUT_BACKEND = 'poll'
+# Directory of the binary input edge logs (one edges_<start time>.bin/.json per run, see syncEvents.py)
+EDGE_LOG_DIR = 'edgeLogs'
+CLOCK_PERIOD = 1.0                                          # timer wheel period of UPTIME, TOD and HEARTBEAT (seconds)
+STATS_PERIOD = 1.0                                          # and of the performance statistics records
+CALIBRATE_PERIOD = 60.0                                     # monotonic() to wall clock offset recalibration (syncClock.calibrate)
+# Simulated generator driving the simulated DAQ lines (--sim, timing defaults in syncSim.CPI_TIMING)
+if SIM:
+    SIM_CPI = CpiModel(DEVICE, CPI_RAD_PREP_IN, CPI_EXPOSE_IN, CPI_RAD_PREP_OUT, CPI_RAD_READY_OUT, CPI_EXPOSE_OUT)
+PV_CONNECT_TIMEOUT  = 5.0                                   # startup wait for the PV registry (seconds)
+SCAN_CANCEL_IOC     = PVS.add(SCAN_IOC + 'AbortScans.PROC')
 # Constant numpy arrays for setting digital outputs high or low on NI-DAQs
 LOW  = numpy.zeros((1,), dtype=numpy.uint8)
 HIGH = numpy.ones((1,), dtype=numpy.uint8)
-POLL_TIME = 0.001                                           # How often to pause in "while" loops
+EXPOSURE_OFF = (('EXPOSE', 0), ('RAD_PREP', 0))             # writeOutputs order: the exposure request drops before rad prep
+LATENCY_BUCKETS = len(LogHistogram().counts)                # number of buckets in the DAQ output latency histogram
+# poll loop profile records, POLL_<PART>_P50/_P99/_MAX -> (part, index into LoopProfiler.summary)
+POLL_STATS = dict(('POLL_%s_%s' % (part.upper(), stat), (part, i))
+                  for part in LoopProfiler.PARTS for i, stat in enumerate(('P50', 'P99', 'MAX')))
 # pcas records
 prefix = EXPERIMENT + 'cpiSync:'
 pvdb = {
@@ -68,44 +105,91 @@ pvdb = {
                                 'value': 'Initialization'},
     'GEN_DELAY'             : { 'value': 0.02, # 20 milliseconds
                                 'prec': 3} ,             
+    'CHANGE_ONLY'           : { 'value': 1 },        # only publish *_RBV records when a polled line flips
+    'SUPPRESSED_UPDATES'    : { 'type': 'int' },
+    'DO_LATENCY'            : { 'prec': 6},              # queue to wire latency of the last DAQ output write
+    'DO_LATENCY_HIST'       : { 'type': 'int',
+                                'count': LATENCY_BUCKETS},
+    'DO_LATENCY_BINS'       : { 'type': 'float',         # lower edge of each DO_LATENCY_HIST bucket (seconds)
+                                'count': LATENCY_BUCKETS},
+    'POLL_PROFILE_DUMP'     : { },                       # write 1 to copy the poll loop histograms to POLL_*_HIST and print them
+    'POLL_PROFILE_RESET'    : { },                       # write 1 to clear the poll loop histograms
+    'EDGE_LOG_COUNT'        : { 'type': 'int' },         # input edges logged since startup
+    'EDGE_LOG_OVERRUNS'     : { 'type': 'int' },         # edges overwritten before they reached the disk
+    'EDGE_LOG_FLUSH'        : { },                       # write 1 to write the logged edges to disk now
+    'LOG_LEVEL'             : { 'type': 'enum',          # DEBUG logs every edge, INFO only status changes
+                                'enums': list(LEVEL_NAMES),
+                                'value': 0},
+    'PV_COUNT'              : { 'type': 'int' },         # PVs in the registry
+    'PV_CONNECTED'          : { 'type': 'int' },         # of them connected now
+    'PV_CONNECT_TIME'       : { 'prec': 4},              # startup wait for the PV connections (at most PV_CONNECT_TIMEOUT)
+    'PV_DISCONNECTED'       : { 'type': 'char',          # names of the PVs not connected now
+                                'count': 2000},
+    'CPU_PERCENT'           : { 'prec': 1},         # process CPU use (% of one core) over the last STATS_PERIOD
 }
+# connection state and first connection latency (CONN_<pv>_TIME) of every PV in the registry
+PV_RECORDS = dict((name, 'CONN_' + re.sub(r'\W', '_', name)) for name in PVS.names())
+for reason in PV_RECORDS.values():
+    pvdb[reason] = { 'type': 'enum',
+                     'enums': ['Disconnected', 'Connected']}
+    pvdb[reason + '_TIME'] = { 'prec': 4}
+# poll loop period, DAQ read and publish time percentiles (histogram buckets are DO_LATENCY_BINS)
+for reason in POLL_STATS:
+    pvdb[reason] = { 'prec': 6}
+for part in LoopProfiler.PARTS:
+    pvdb['POLL_%s_HIST' % part.upper()] = { 'type': 'int',
+                                            'count': LATENCY_BUCKETS}
 
 pvdb.update(epicsApps.pvdb)
 class myDriver(Driver):
-    def  __init__(self):
+    def  __init__(self, inputBackend=INPUT_BACKEND):
         super(myDriver, self).__init__()
         self.start_time = datetime.now()
         self.iocStats()
         self.cancel = 0                                     # cancel flag for abort procedure 
         self.currentFunction = ''                           # initialize current function string used in status messages
-        self.seqInProgress=0                                # flag to determine if we are inside a "sequence" or not
+        self.seqInProgress=0                                # 1 from an accepted EXPOSE 1 until the exposure ends
+        self.lineState = LineState(INPUT_RECORDS + ('seqInProgress',)) # abort blocks on it instead of polling seqInProgress
         # The following variable is needed for pydaqmx
         self.written = int32()
+        self.suppressedUpdates = 0                          # poll passes where no line changed and publishing was skipped
+        self.daqOut = OutputWorker()                        # all DAQ output writes go through one ordered queue
+        self.setParam('DO_LATENCY_BINS', [0.0] + self.daqOut.histogram.edges)
+        self.pollProfile = LoopProfiler()                   # histograms of the poll loop period, DAQ read time and publish time
+        self.fileJobs = JobQueue('fileWriter')              # file writes happen on this thread
+        self.process = psutil.Process(os.getpid())          # CPU_PERCENT source
+        self.process.cpu_percent()
+        # every input edge (line, direction, timestamp), written to disk in bulk by the file writer
+        self.edgeLog = EdgeLog(os.path.join(EDGE_LOG_DIR, 'edges_' + time.strftime("%Y%m%d-%H%M%S")), INPUT_RECORDS, self.fileJobs)
+        self.connectPVs()                                   # every PV has been connecting since import
         SCAN_CANCEL_IOC.add_callback(callback=self.ScanMonitor)
         # Setup DO lines
+        self.portTask = None
+        if PORT_OUTPUT:
+            self.setupPortOutput(OUTPUT_LINES)
         self.radPrepInTask = TaskHandle()
         self.setupOutput(self.radPrepInTask, CPI_RAD_PREP_IN, True)
         self.exposeInTask = TaskHandle()
         self.setupOutput(self.exposeInTask, CPI_EXPOSE_IN, True)   
         self.exposeOkInTask = TaskHandle()
         self.setupOutput(self.exposeOkInTask, CPI_EXPOSE_OK_IN, True)
-        # Task to read DI lines combined into one (significantly improves performance to do one read)
-        self.combinedTask = TaskHandle()
-        DAQmxCreateTask("",byref(self.combinedTask))
-        DAQmxCreateDIChan(self.combinedTask, INPUT_POLL, "", DAQmx_Val_ChanForAllLines)
-        DAQmxStartTask(self.combinedTask)      
-        # start the polling thread
-        self.cid = threading.Thread(target=self.pollInputs,args=())
-        self.cid.start()
+        # Output records and their lines, for changing several at once with writeOutputs
+        self.outputTasks = {'RAD_PREP'    : self.radPrepInTask,
+                            'EXPOSE'      : self.exposeInTask}
+        self.outputLines = {'RAD_PREP'    : CPI_RAD_PREP_IN,
+                            'EXPOSE'      : CPI_EXPOSE_IN}
+        self.cpiExposeStartTime = 0
+        self.cpiExposeEndTime = 0
+        # Start watching the input lines
+        self.setupInput(inputBackend)
         # set this line on init
         self.ExposeOkOn()
         epicsApps.buildRequestFiles(prefix, pvdb.keys(), os.getcwd())
         epicsApps.makeAutosaveFiles()
+        self.startTimers()                                  # UPTIME, TOD, HEARTBEAT and the statistics records from now on
         # Now ready to do exposures, change from Initilization to Idle 
         self.write('STATUS_RBV', 'Idle')
-        print '############################################################################'
-        print '## CMP-200 SYNC PCAS IOC Online $Date:' + str(datetime.now())[:-3]
-        print '############################################################################'
+        LOG.info('## CMP-200 SYNC PCAS IOC Online ##')
 
     def iocStats(self):
         """
@@ -120,10 +204,44 @@ class myDriver(Driver):
         self.setParam('PARENT_ID', os.getpid())
         self.setParam('HEARTBEAT', 0)
 
+    def connectPVs(self):
+        """
+        Waits up to PV_CONNECT_TIMEOUT for the PV registry, then publishes and follows every PV connection state
+        """
+        start = monotonic()
+        missing = PVS.waitConnected(PV_CONNECT_TIMEOUT)
+        self.setParam('PV_CONNECT_TIME', monotonic() - start)
+        self.setParam('PV_COUNT', len(PV_RECORDS))
+        PVS.onConnection(self.pvConnection)
+        for name, connected, latency in PVS.status():
+            self.pvConnection(name, connected, latency)
+        if missing:
+            LOG.warning('%d of %d PVs not connected after %.1f s: %s', len(missing), len(PV_RECORDS),
+                        PV_CONNECT_TIMEOUT, ' '.join(missing))
+
+    def pvConnection(self, name, connected, latency):
+        """
+        PV registry connection callback (CA thread)
+        """
+        reason = PV_RECORDS.get(name)
+        if reason is None:
+            return
+        self.setParam(reason, int(connected))
+        if latency is not None:
+            self.setParam(reason + '_TIME', latency)
+        missing = [n for n in PVS.missing() if n in PV_RECORDS]
+        self.setParam('PV_CONNECTED', len(PV_RECORDS) - len(missing))
+        self.setParam('PV_DISCONNECTED', ' '.join(missing))
+        self.updatePVs()
+
     def setupOutput(self, taskName, lineLocation, setLow):
         """
          Generic function for setting up daq output
+         With the port task the line is only registered, it is already in the port task and low
         """
+        if self.portTask is not None:
+            self.portLines.append((taskName, lineLocation))
+            return
         DAQmxCreateTask("",byref(taskName))
         DAQmxCreateDOChan(taskName, lineLocation, "", DAQmx_Val_ChanForAllLines)
         DAQmxSetDOOutputDriveType(taskName, lineLocation, DAQmx_Val_ActiveDrive)
@@ -131,56 +249,142 @@ class myDriver(Driver):
         if setLow == True:
             self.setDigiOut(taskName, LOW)
 
+    def setupPortOutput(self, lines):
+        """
+        Set up one task for all output lines, a shadow copy of the lines lets us write one or many of them in one call
+        """
+        self.portShadow = PortShadow(lines)
+        self.portLines = []                                 # (per line task handle, line name), ctypes handles can't be dict keys
+        self.portTask = TaskHandle()
+        channels = ",".join(lines)
+        DAQmxCreateTask("",byref(self.portTask))
+        DAQmxCreateDOChan(self.portTask, channels, "", DAQmx_Val_ChanForAllLines)
+        DAQmxSetDOOutputDriveType(self.portTask, channels, DAQmx_Val_ActiveDrive)
+        DAQmxStartTask(self.portTask)
+        self.processDAQstatus(DAQmxWriteDigitalLines(self.portTask,1,1,10.0,DAQmx_Val_GroupByChannel, self.portShadow.values, self.written, None))
+
+    def setupInput(self, backend):
+        """
+        Set up the task that reads all input lines at once (significantly improves performance to do one read)
+        and start the selected input backend. Both backends hand each new read of the lines to processInputs
+        -'poll':   a thread reads the lines as fast as it can (the usb-6501 doesnt support change detection)
+        -'change': DAQmx change detection calls DIChangeCallback on every edge, no thread spinning on the DAQ
+        """
+        self.combinedTask = TaskHandle()
+        DAQmxCreateTask("",byref(self.combinedTask))
+        DAQmxCreateDIChan(self.combinedTask, INPUT_POLL, "", DAQmx_Val_ChanForAllLines)
+        DAQmxStartTask(self.combinedTask)
+        # Current state of the lines, publish everything once
+        self.inputValues = np.zeros((len(INPUT_RECORDS),), dtype=np.uint8)
+        DAQmxReadDigitalLines(self.combinedTask, 1, 1, 0, self.inputValues, len(INPUT_RECORDS), None, None, None)
+        self.inputWord = int(np.dot(self.inputValues, INPUT_BITS))
+        for i, record in enumerate(INPUT_RECORDS):
+            self.setParam(record, self.inputValues[i])
+        self.updatePVs()
+        self.lineState.update(dict(zip(INPUT_RECORDS, self.inputValues)))
+        if backend == 'change':
+            DAQmxStopTask(self.combinedTask)
+            # Keep a reference to the callback pointer, otherwise it gets garbage collected
+            self._DIChangeCallback = DAQmxSignalEventCallbackPtr(self.DIChangeCallback)
+            DAQmxCfgChangeDetectionTiming(self.combinedTask, INPUT_POLL, INPUT_POLL, DAQmx_Val_ContSamps, 8)
+            DAQmxRegisterSignalEvent(self.combinedTask, DAQmx_Val_ChangeDetectionEvent, 0, self._DIChangeCallback, None)
+            DAQmxStartTask(self.combinedTask)
+        else:
+            # start the polling thread
+            self.cid = threading.Thread(target=self.pollInputs,args=())
+            self.cid.start()
+        LOG.info('Input backend: %s', backend)
+
     def pollInputs(self):
         """
         For the usb-6501 we have to perform change detection via polling the input lines
         """
-        oldval = np.array([0,0,0], dtype=np.uint8)
-        newval = np.array([0,0,0], dtype=np.uint8)
-        DAQmxReadDigitalLines(self.combinedTask, 1, 1, 0,  oldval, 3, None, None, None)
+        newval = np.zeros((len(INPUT_RECORDS),), dtype=np.uint8)
         while True:
-            startPollTime = time.clock()
+            startPollTime = monotonic()
             DAQmxReadDigitalLines(self.combinedTask, 1, 1, 0, newval, 3, None, None, None)     
-            self.setParam("RAD_PREP_RBV",      newval[0])
-            self.setParam("RAD_READY_RBV",     newval[1])
-            self.setParam("EXPOSE_RBV",        newval[2])
-            self.updatePVs()
-            if newval[2] != oldval[2]:
-                if newval[2] == 1:
-                    print str(datetime.now())[:-3], 'GENERATOR EXPOSE START'
-                    self.cpiExposeStartTime = time.clock()
-                else:
-                    self.write("EXPOSE", 0)
-                    print str(datetime.now())[:-3], 'GENERATOR EXPOSE END',
-                    self.cpiExposeEndTime=time.clock()
-                    print str(datetime.now())[:-3], 'TOTAL EXPOSURE TIME', '%2.6f'%(self.cpiExposeEndTime - self.cpiExposeStartTime)
-                    if newval[1] == 1:
-                        self.lastCpiExposure = time.time()
-            self.updatePVs()
-            # Note: the below line is for storing the old value of array (before new read)
-            # it must use the copy method, otherwise it will access the location of the array
-            oldval = newval.copy()
-            endPollTime = time.clock()
-#            if endPollTime - startPollTime > 0.002:
-#                print str(datetime.now())[:-3], 'DAQ Poll > 2 ms !', endPollTime - startPollTime
+            readTime = monotonic()
+            self.processInputs(newval, readTime)
+            endPollTime = monotonic()
+            self.pollProfile.record(startPollTime, readTime, endPollTime)
 
-    def read(self, reason):
+    def DIChangeCallback(self, taskHandle, status, callbackData):
         """
-        pcaspy native read method
-        """
-        format_time = ""
-        if reason == 'UPTIME':
-            format_time = datetime.now() - self.start_time
-            value  = str(format_time).split(".")[0] 
-        elif reason == 'TOD':
-            value = str(datetime.now().strftime("%m/%d/%Y %H:%M:%S"))
-        elif reason == 'HEARTBEAT':
-            value = self.getParam('HEARTBEAT') + 1
-            self.setParam('HEARTBEAT', value)
+        DAQmx change detection event, one sample is buffered per change
+        """
+        timestamp = monotonic()
+        newval = np.zeros((len(INPUT_RECORDS),), dtype=np.uint8)
+        DAQmxReadDigitalLines(self.combinedTask, 1, 1, 0, newval, 3, None, None, None)
+        self.processInputs(newval, timestamp)
+        return 0 # DAQMX requires callback function to return an integer
+
+    def processInputs(self, newval, timestamp):
+        """
+        Handle a new read of the input lines taken at timestamp (from either input backend).
+        The lines are packed into one word so an unchanged read costs one integer compare,
+        and only the records of lines that flipped are pushed to pcaspy (unless CHANGE_ONLY is 0)
+        """
+        newword = int(np.dot(newval, INPUT_BITS))
+        if self.getParam('CHANGE_ONLY') == 1:
+            changed = newword ^ self.inputWord
         else:
-            value = self.getParam(reason)
+            changed = (1 << len(INPUT_RECORDS)) - 1
+        if changed == 0:
+            self.suppressedUpdates += 1
+            return
+        self.edgeLog.record(newword ^ self.inputWord, newword, timestamp)
+        for i, record in enumerate(INPUT_RECORDS):
+            if changed >> i & 1:
+                self.setParam(record, newval[i])
+        if newval[2] != self.inputValues[2]:
+            if newval[2] == 1:
+                LOG.debug('GENERATOR EXPOSE START')
+                self.cpiExposeStartTime = timestamp
+            else:
+                self.write("EXPOSE", 0)
+                LOG.debug('GENERATOR EXPOSE END')
+                self.cpiExposeEndTime = timestamp
+                LOG.debug('TOTAL EXPOSURE TIME %2.6f', self.cpiExposeEndTime - self.cpiExposeStartTime)
+                if newval[1] == 1:
+                    self.lastCpiExposure = time.time()
         self.updatePVs()
-        return value
+        # Note: the below line is for storing the old value of array (before new read)
+        # it must use the copy method, otherwise it will access the location of the array
+        self.inputValues = newval.copy()
+        self.inputWord = newword
+        self.lineState.update(dict((record, self.inputValues[i]) for i, record in enumerate(INPUT_RECORDS) if changed >> i & 1))
+
+    def read(self, reason):
+        """
+        pcaspy native read method, periodic records are kept current by the timer wheel (see startTimers)
+        so reading is only a param lookup
+        """
+        return self.getParam(reason)
+
+    def startTimers(self):
+        """
+        Timer wheel callbacks, each sets its records and the wheel calls updatePVs once per tick
+        """
+        self.timers = TimerWheel('periodicRecords', after=self.updatePVs)
+        self.timers.every(CLOCK_PERIOD, self.updateClock)
+        self.timers.every(CALIBRATE_PERIOD, calibrate)
+        self.timers.every(STATS_PERIOD, self.updateStats)
+
+    def updateClock(self):
+        now = datetime.now()
+        self.setParam('UPTIME', str(now - self.start_time).split(".")[0])
+        self.setParam('TOD', now.strftime("%m/%d/%Y %H:%M:%S"))
+        self.setParam('HEARTBEAT', self.getParam('HEARTBEAT') + 1)
+
+    def updateStats(self):
+        self.setParam('SUPPRESSED_UPDATES', self.suppressedUpdates)
+        self.setParam('DO_LATENCY', self.daqOut.lastLatency)
+        self.setParam('DO_LATENCY_HIST', list(self.daqOut.histogram.counts))
+        for reason, (part, index) in POLL_STATS.items():
+            self.setParam(reason, self.pollProfile.summary(part)[index])
+        self.setParam('EDGE_LOG_COUNT', self.edgeLog.count)
+        self.setParam('EDGE_LOG_OVERRUNS', self.edgeLog.overruns)
+        self.setParam('CPU_PERCENT', self.process.cpu_percent())
 
     def write(self, reason, value):
         """
@@ -189,18 +393,52 @@ class myDriver(Driver):
         self.setParam(reason, value)
         self.updatePVs()
         if  reason == 'RAD_PREP':
-            self.did = threading.Thread(target = self.setDigiOut, args = (self.radPrepInTask, value))
-            self.did.start()
+            self.daqOut.put(self.setDigiOut, self.radPrepInTask, value)
         elif reason == 'EXPOSE':
             if (self.getParam("RAD_PREP_RBV") == 1 and value == 1) or value == 0:
-                self.did = threading.Thread(target = self.setDigiOut, args = (self.exposeInTask, value))
-                self.did.start()
+                self.daqOut.put(self.setDigiOut, self.exposeInTask, value)
+                # an exposure is this driver's sequence, from the request until it ends (processInputs writes EXPOSE 0)
+                self.setSeqInProgress(value)
         elif reason == 'ABORT' and value == 1:
             self.fid = threading.Thread(target = self.abort, args = ())
             self.fid.start()
+        elif reason == 'POLL_PROFILE_DUMP' and value == 1:
+            self.dumpPollProfile()
+        elif reason == 'POLL_PROFILE_RESET' and value == 1:
+            self.pollProfile.reset()
+        elif reason == 'EDGE_LOG_FLUSH' and value == 1:
+            self.edgeLog.queueFlush()
+        elif reason == 'LOG_LEVEL':
+            LOG.setLevel(LEVEL_NAMES[value])
         elif reason == 'STATUS_RBV':
-            print str(datetime.now())[:-3], value
+            LOG.info(value)
+        self.updatePVs()
+
+    def writeOutputs(self, changes):
+        """
+        Change several output records at once, changes is a sequence of (record, value) written in that order.
+        All lines go out in one queued write (one USB transaction when using the port task)
+        """
+        for reason, value in changes:
+            self.setParam(reason, value)
+        self.updatePVs()
+        self.daqOut.put(self.setDigiOutLines, changes)
+
+    def dumpPollProfile(self):
+        """
+        Copy the full poll loop histograms to the POLL_*_HIST records and print them
+        """
+        for part in LoopProfiler.PARTS:
+            self.setParam('POLL_%s_HIST' % part.upper(), list(self.pollProfile.histograms[part].counts))
         self.updatePVs()
+        LOG.info('Poll loop profile\n%s', self.pollProfile.dump())
+
+    def setSeqInProgress(self, value):
+        """
+        Sequences call this when they start/finish so abort can wait for them
+        """
+        self.seqInProgress = value
+        self.lineState.update({'seqInProgress': value})
 
     def abort(self):
         """
@@ -209,15 +447,15 @@ class myDriver(Driver):
         -Turn expose off
         -Turn radprep off
         -cancel scan if in progress 
-        -Wait for all sequences to finish (self.seqInProgress=0)
+        -Wait for the exposure in progress to finish (self.seqInProgress=0), or for none to be running
         """
         self.write('STATUS_RBV', self.currentFunction + ' ABORTING!')
         self.cancel=1 # flag to tell exposures to cancel
-        self.write('EXPOSE', 0)
-        self.write('RAD_PREP',0)
-        # wait for any sequence in progress to finish
-        while self.seqInProgress == 1:
-            time.sleep(POLL_TIME)
+        self.lineState.wake() # waiters re-check the cancel flag
+        self.writeOutputs(EXPOSURE_OFF)
+        # wait for the exposure in progress to end, nothing to wait for if the generator never started it
+        self.lineState.waitUntil(lambda lines: lines['seqInProgress'] == 0 or lines['EXPOSE_RBV'] == 0)
+        self.setSeqInProgress(0)
         self.cancel=0
         self.write('STATUS_RBV', self.currentFunction + ' Abort complete')
         
@@ -225,7 +463,7 @@ class myDriver(Driver):
         """
         Need to monitor scan abort PV so we can properly disable exposure/RadPrep
         """
-        print str(datetime.now())[:-3], 'Scan Abort Callback'
+        LOG.info('Scan Abort Callback')
         # This if statement is true if the scan was canceled, and Radprep is true
         if self.getParam('RAD_PREP')== 1 and self.cancel == 0 : 
             self.aid = threading.Thread(target = self.abort, args = ())
@@ -238,6 +476,9 @@ class myDriver(Driver):
         self.setDigiOut(self.exposeOkInTask, LOW)
     
     def setDigiOut(self, DAQtaskName, value ):
+        if self.portTask is not None:
+            self.writePortLines([(self.portLine(DAQtaskName), value)])
+            return
         if type(value) != numpy.ndarray:
             if value == 0:
                 value = LOW
@@ -245,20 +486,67 @@ class myDriver(Driver):
                 value = HIGH
         self.processDAQstatus(DAQmxWriteDigitalLines(DAQtaskName,1,1,10.0,DAQmx_Val_GroupByChannel, value ,self.written, None))
 
+    def setDigiOutLines(self, changes):
+        """
+        Write several output records in order, changes is a sequence of (record (outputTasks key), value).
+        With the port task this is a single DAQmxWriteDigitalLines call
+        """
+        if self.portTask is None:
+            for reason, value in changes:
+                self.setDigiOut(self.outputTasks[reason], value)
+        else:
+            self.writePortLines([(self.outputLines[reason], value) for reason, value in changes])
+
+    def writePortLines(self, changes):
+        """
+        Write lines of the port task, changes is a sequence of (line name, value)
+        """
+        values = self.portShadow.apply(changes)
+        self.processDAQstatus(DAQmxWriteDigitalLines(self.portTask,1,1,10.0,DAQmx_Val_GroupByChannel, values ,self.written, None))
+
+    def portLine(self, DAQtaskName):
+        """
+        Line name of a per line task handle registered with the port task (compared by identity)
+        """
+        for task, line in self.portLines:
+            if task is DAQtaskName:
+                return line
+        raise KeyError('task not in the port task')
+
     def processDAQstatus(self, errorcode):
         if errorcode != 0:
-            print str(datetime.now())[:-3], "NI-DAQ error! Code:", errorcode
+            LOG.error('NI-DAQ error! Code: %s', errorcode)
 
 if __name__ == '__main__':
     server = SimpleServer()
+    parser = argparse.ArgumentParser(description='CMP-200 sync pcas IOC')
+    parser.add_argument('--input', choices=('poll', 'change'), default=INPUT_BACKEND,
+                        help='input edge detection: poll the lines, or DAQmx change detection callbacks')
+    parser.add_argument('--sim', action='store_true',
+                        help='run without hardware, against the simulated DAQ and generator/camera models in syncSim')
+    parser.add_argument('--log-level', choices=LEVEL_NAMES, default='DEBUG',
+                        help='DEBUG logs every edge and sequence step, use INFO or above in production')
+    args = parser.parse_args()
+    pvdb['LOG_LEVEL']['value'] = LEVEL_NAMES.index(args.log_level)
+    LOG.setLevel(args.log_level)
     server.createPV(prefix, pvdb)
-    driver = myDriver()
-    # process CA transactions
-    while True:
-        try:
-            server.process(0.0001)
-        except KeyboardInterrupt:
-            try:
-                sys.exit(0)
-            except SystemExit:
-                os._exit(0)
+    driver = myDriver(inputBackend=args.input)
+    # CA transactions are served by pcaspy's server thread, blocking in select() between requests.
+    #   The main thread only waits for Ctrl-C / SIGTERM and shuts down
+    serverThread = ServerThread(server)
+    serverThread.start()
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        while serverThread.is_alive():
+            time.sleep(1.0)
+    except KeyboardInterrupt:
+        pass
+    serverThread.stop()
+    # the last edges go through the file writer like every other flush, and it finishes its queue first
+    driver.edgeLog.queueFlush()
+    driver.fileJobs.join()
+    LOG.flush()
+    os._exit(0) # the DAQ and pcaspy threads would keep the process alive
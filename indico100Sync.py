@@ -1,14 +1,33 @@
 #!/usr/bin/env python
 from pcaspy import Driver, SimpleServer, cas
-import time, threading, winsound, os, os.path, pickle, socket, platform, sys
-from PyDAQmx import *
-from epics import *
+from pcaspy.tools import ServerThread
+import time, threading, os, os.path, socket, platform, sys, argparse, re
+try:
+    import winsound
+except ImportError:
+    winsound = None # not on Windows (simulation)
+# --sim replaces the NI-DAQ and EPICS with the simulated DAQ, PVs and CPI/Qi2 models in syncSim (must be known before the import)
+SIM = '--sim' in sys.argv
+if SIM:
+    from syncSim import *
+else:
+    from PyDAQmx import *
+    from epics import *
 import numpy as np
 from datetime import datetime, timedelta
-import psutil, gc
+import psutil, gc, signal
 from multiprocessing import Process
 sys.path.append(os.path.realpath('../utils'))
 import epicsApps
+from syncDaq import OutputWorker, PortShadow, LineState
+from syncTiming import LogHistogram, DelayScheduler, TimingBuffer, LoopProfiler, FramePLL, LatencyModel
+from syncJobs import JobQueue, TimerWheel
+from syncEpics import PVS, PVSnapshot, MonitoredPV, ScanState
+from syncReport import ScanReport, writeReport, REPORT_WRITERS
+from syncPersist import PersistentValue
+from syncEvents import EdgeLog
+from syncClock import monotonic, calibrate
+from syncLog import LOG, LEVEL_NAMES
 
 """
 11/18/2015 (AAG)
@@ -62,17 +81,13 @@ This was so the terminology in the documentation for the cpi matches with the na
 
 """
 grab last exposure time so we know when warmup is required
+(saved in the background by the driver, at most once a second and at shutdown)
 """
-try:
-    if os.path.isfile('objs.pickle'):
-        with open('objs.pickle') as f:
-            lastCpiExposure = pickle.load(f)
-    else:
-        print 'lastcpiexposure load fail'
-        lastCpiExposure = time.time()
-except:
-        print 'lastcpiexposure load fail'
-        lastCpiExposure = time.time()
+LAST_EXPOSURE_STORE = PersistentValue('objs.pickle')
+lastCpiExposure = LAST_EXPOSURE_STORE.load(time.time())
+# photospot to expose latency per generator setting (kVp, mA, focus), learned from every exposure and kept across restarts
+LATENCY_STORE = PersistentValue('latencyModel.pickle')
+LATENCY_MODEL = LatencyModel(LATENCY_STORE.load({}))
 
 
 # make this python process a high priority in Windows
@@ -81,7 +96,7 @@ try:
     p.nice(psutil.HIGH_PRIORITY_CLASS)
     #p.nice(psuitl.REALTIME_PRIORITY_CLASS) #currently doesn't work 
 except:
-    print 'failed to make process high priority'
+    LOG.warning('failed to make process high priority')
 
 
 EXPERIMENT          = 'HPFI:'
@@ -97,6 +112,10 @@ CPI_POWER_OFF_LINE  = DAQ_NAME + '/port0/line4' # pulse turns CPI off
 CPI_POWER_ON_LINE   = DAQ_NAME + '/port0/line5' # pulse turns CPI on
 CPI_RAD_PREP_IN     = DAQ_NAME + '/port0/line6' # setting high makes enables rad prep
 QI2_EXPOSE          = DAQ_NAME + '/port2/line0' # Output from DAQ to Qi2 requests exposure
+# Drive all the output lines from one port level task (one USB transaction no matter how many lines change)
+# instead of one task per line
+PORT_OUTPUT         = False
+OUTPUT_LINES        = [CPI_FLUORO_IN, CPI_PHOTOSPOT_IN, CPI_EXPOSE_IN, CPI_POWER_OFF_LINE, CPI_POWER_ON_LINE, CPI_RAD_PREP_IN, QI2_EXPOSE]
 # These are the DAQ inputs (output from CPI etc.)
 QI2_TRIGGERREADY    = DAQ_NAME  + '/port2/line1' # High when Qi2 ready to expose
 QI2_EXPOSEOUT       = DAQ_NAME  + '/port2/line2' # QI2_EXPOSEOUT is high when it is exposing
@@ -107,31 +126,86 @@ CPI_FLUORO_OUT      = DAQ_NAME  + '/port1/line3'
 
 # These are the lines that will be polled for change detection
 INPUT_POLL= CPI_RAD_PREP_OUT + "," + CPI_RAD_READY_OUT + "," + CPI_EXPOSE_OUT  + "," + CPI_FLUORO_OUT + "," + QI2_TRIGGERREADY + "," + QI2_EXPOSEOUT 
+# pcas records for each polled line (same order as INPUT_POLL)
+INPUT_RECORDS = ('RAD_PREP_RBV', 'RAD_READY_RBV', 'EXPOSE_RBV', 'FLUORO_RBV', 'TRIGGER_READY_RBV', 'EXPOSING_RBV')
+# bit weights used to pack the polled lines into one word for change detection
+INPUT_BITS = 1 << np.arange(len(INPUT_RECORDS))
+# How input edges are detected: 'poll' (usb-6501, no hardware change detection) or 'change'
+# (DAQmx change detection callbacks, e.g. usb-6525). Can be overridden with --input at startup
+INPUT_BACKEND = 'poll'
+# Every PV below is a handle from the PVS registry, created here so they all connect in parallel at startup
+#   and myDriver waits for them against one deadline (seconds)
+PV_CONNECT_TIMEOUT  = 5.0
+# longest a scan point waits for the previous (pipelined) point to finish its bookkeeping (seconds)
+SEQ_WAIT_TIMEOUT    = 10.0
 # EPICS scan variables to keep track of scan so we know when to start/stop rad prep 
-SCAN_DETECTOR_1     = PV(SCAN_IOC + 'scan1.T1PV', callback = False)
+SCAN_DETECTOR_1     = PVS.add(SCAN_IOC + 'scan1.T1PV')
+SCAN_WAIT_PV        = PVS.add(SCAN_IOC + 'scan1.WAIT') # 0 releases the scan to the next point
+SCAN_KVP_WAIT_PV    = PVS.add(SCAN_IOC + '.WAIT', optional=True) # released by single shots of a kVp scan, not waited for at startup
 # very important to use scanProgress record instead of scan, so we can keep track of multi-dimensional scans
 SCANPROGRESSIOC     = SCAN_IOC + 'scanProgress:' 
 # So we know to immediately shut off ranode if scan is canceled, and initiate abort() function
-SCAN_CANCEL_IOC     = PV(SCAN_IOC + 'AbortScans.PROC', callback = True)
-# Keep track of scan status 
-NFINISHED_PV        = PV(SCANPROGRESSIOC +'Nfinished')
-NTOTAL_PV           = PV(SCANPROGRESSIOC +'Ntotal')
-CPT_PV              = PV(SCAN_IOC + 'scan1.CPT')
-NPTS_PV             = PV(SCAN_IOC + 'scan1.NPTS') 
+SCAN_CANCEL_IOC     = PVS.add(SCAN_IOC + 'AbortScans.PROC')
+# Keep track of scan status (Nfinished, Ntotal, running, CPT, NPTS, P1PV), monitored so checks during a scan are local reads
+SCAN_STATE          = ScanState(SCAN_IOC + 'scan1', SCANPROGRESSIOC)
 # Functions to allow changes of CPI settings for automatic warm-up procedures 
-CPI_KVP_PV          = PV(XRAY_IOC + 'SetKVP')
-CPI_MA_PV           = PV(XRAY_IOC + 'SetMA')
-CPI_MS_PV           = PV(XRAY_IOC + 'SetMS')
-CPI_SETFOCUS_PV     = PV(XRAY_IOC + 'SetFocus')
+CPI_KVP_PV          = PVS.add(XRAY_IOC + 'SetKVP')
+CPI_MA_PV           = PVS.add(XRAY_IOC + 'SetMA')
+CPI_MS_PV           = PVS.add(XRAY_IOC + 'SetMS')
+CPI_SETFOCUS_PV     = PVS.add(XRAY_IOC + 'SetFocus')
+CPI_GETKVP_PV       = PVS.add(XRAY_IOC + 'GetKVP.PROC') # reads the generator settings back
+# Generator serial status, monitored so prepExpose can block until the generator reports it is ready to expose
+GENERATOR_STATUS_PV = MonitoredPV(XRAY_IOC + 'GeneratorStatus')
+GENERATOR_EXPOSURE_STATUS = 4
+# Simulated generator and camera driving the simulated DAQ lines (--sim, timing defaults in syncSim.CPI_TIMING/QI2_TIMING)
+if SIM:
+    SIM_CPI = CpiModel(DEVICE, CPI_RAD_PREP_IN, CPI_EXPOSE_IN, CPI_RAD_PREP_OUT, CPI_RAD_READY_OUT, CPI_EXPOSE_OUT,
+                       photospotIn=CPI_PHOTOSPOT_IN)
+    SIM_QI2 = Qi2Model(DEVICE, QI2_EXPOSE, QI2_TRIGGERREADY, QI2_EXPOSEOUT)
+    # no CPI IOC in simulation, the model posts its serial status to the simulated GeneratorStatus PV
+    SIM_CPI.onStatus(GENERATOR_STATUS_PV.pv.put)
 # What PV's to grab the filepath and filename from for text doc writing
-FILEPATH_PV         = PV(DET_IOC + 'TIFF1:FilePath')
-FILENAME_PV         = PV(DET_IOC + 'TIFF1:FileName', callback = True) #reset Filenum to zero when called
+FILEPATH_PV         = PVS.add(DET_IOC + 'TIFF1:FilePath')
+FILENAME_PV         = PVS.add(DET_IOC + 'TIFF1:FileName') #reset Filenum to zero when called
+FILENUMBER_PV       = PVS.add(DET_IOC + 'TIFF1:FileNumber')
+# Qi2 acquisition (live view) start/stop
+ACQUIRE_PV          = PVS.add(DET_IOC + 'cam1:Acquire')
 #Constant numpy arrays for setting digital outputs high or low on NI-DAQs
 LOW  = numpy.zeros((1,), dtype=numpy.uint8)
 HIGH = numpy.ones((1,), dtype=numpy.uint8)
+#writeOutputs sequences, written in this order: the triggers drop first, then the exposure request before rad prep
+EXPOSURE_OFF = (('EXPOSE', 0), ('RAD_PREP', 0))
+ALL_OUTPUTS_OFF = (('PHOTOSPOT', 0), ('SEND_TRIGGER', 0), ('FLUORO', 0)) + EXPOSURE_OFF
 
 #How often to pause in "while" loops
 POLL_TIME = 0.001
+#Pause before a sequence raises RAD_PREP in to the CPI (seconds)
+RAD_PREP_DELAY = 0.1
+# Timing records that keep per shot statistics for the end of scan report, and how many shots each buffer holds
+TIMING_RECORDS = ('SeqStarttoQi2', 'TimeBetweenReq', 'Qi2ReqToStart', 'CpiReqToStart', 'CpiStarttoQi2Start',
+                  'Qi2Duration', 'CpiDuration', 'DutyCycle', 'ShotDuration', 'PrepToReady',
+                  'GEN_DELAY_ACHIEVED', 'GEN_DELAY_ERROR')
+TIMING_CAPACITY = 16384
+# Number of most recent shots in the rolling statistics and waveform (<record>_WF) of each timing record
+TIMING_WINDOW = 100
+# End of scan timing report file formats (see syncReport.REPORT_WRITERS), can be overridden with --report at startup
+REPORT_FORMATS = ('txt',)
+# Directory of the binary input edge logs (one edges_<start time>.bin/.json per run, see syncEvents.py)
+EDGE_LOG_DIR = 'edgeLogs'
+# Periods (seconds) of the records the timer wheel recomputes: LAST_EXPOSE_TIME_RBV, UPTIME/TOD/HEARTBEAT and the
+#   performance statistics (SUPPRESSED_UPDATES, DO_LATENCY*, POLL_*, EDGE_LOG_*, CPU_PERCENT)
+LAST_EXPOSE_PERIOD = 1.0
+CLOCK_PERIOD       = 1.0
+STATS_PERIOD       = 1.0
+# and how often the monotonic() to wall clock offset is recalibrated (syncClock.calibrate)
+CALIBRATE_PERIOD   = 60.0
+# and the rolling window records of the timing records (<record>_MEAN/_STD/_MIN/_MAX/_WF) that got new shots
+TIMING_STATS_PERIOD = 0.5
+# number of buckets in the DAQ output latency histogram
+LATENCY_BUCKETS = len(LogHistogram().counts)
+# poll loop profile records, POLL_<PART>_P50/_P99/_MAX -> (part, index into LoopProfiler.summary)
+POLL_STATS = dict(('POLL_%s_%s' % (part.upper(), stat), (part, i))
+                  for part in LoopProfiler.PARTS for i, stat in enumerate(('P50', 'P99', 'MAX')))
 
 # List of PV's to save to text file if DOC is ON (1).
 HPFI_PV_LIST = ['HPFI:KOHZU:m1.RBV',  'HPFI:KOHZU:m2.RBV',  'HPFI:KOHZU:m3.RBV',  \
@@ -142,6 +216,8 @@ HPFI_PV_LIST = ['HPFI:KOHZU:m1.RBV',  'HPFI:KOHZU:m2.RBV',  'HPFI:KOHZU:m3.RBV',
                 'HPFI:KOHZU:m16.RBV', 'HPFI:KOHZU:m17.RBV', 'HPFI:KOHZU:m18.RBV', \
                ]
 PV_LIST      = HPFI_PV_LIST
+# monitored PV_LIST values, so the doc string is a local read instead of a caget per PV
+DOC_PVS      = PVSnapshot(PV_LIST)
 prefix = EXPERIMENT + 'cpiSync:'
 
 pvdb = {
@@ -164,14 +240,40 @@ pvdb = {
     'STATUS_RBV'            : { 'type': 'char',
                                 'count': 300,
                                 'value': 'Initialization'},
-    'LAST_EXPOSE_TIME_RBV'  : { 'type': 'string',
-                                'scan': 1},
+    'LAST_EXPOSE_TIME_RBV'  : { 'type': 'string'},
     'TRIGGER_READY_RBV'     : { 'asyn' : True},
     'EXPOSING_RBV'          : { 'asyn' : True},
     'DOC'                   : { },
     'GEN_DELAY'             : {  'value': 0.02,# 20 milliseconds
                                  'prec': 3} ,
-    'HighSpeedCpiTest'      : { },
+    'GEN_DELAY_SPIN'        : {  'value': 0.003, # last part of GEN_DELAY spent spinning instead of sleeping
+                                 'prec': 4} ,
+    'GEN_DELAY_ACHIEVED'    : {  'prec': 6} ,   # measured Qi2 trigger to CPI photospot delay of the last shot
+    'GEN_DELAY_ERROR'       : {  'prec': 6} ,   # GEN_DELAY_ACHIEVED - GEN_DELAY
+    'PREDICTIVE_TRIGGER'    : {  'value': 0 },  # 1: fire the photospot early by the latency learned for the current setting,
+                                                #   GEN_DELAY is then Qi2 trigger to x-ray start and LIVE_LEAD is ignored
+    'PS_LATENCY'            : {  'prec': 5},    # last photospot to CPI expose out latency
+    'PS_LATENCY_MEAN'       : {  'prec': 5},    # learned latency of the current generator setting
+    'PS_LATENCY_STD'        : {  'prec': 5},
+    'PS_LATENCY_COUNT'      : {  'type': 'int' }, # shots behind it (0: pooled over all settings)
+    'PS_LATENCY_SIGMAS'     : {  'value': 3.0,  # jitter margin in standard deviations
+                                 'prec': 1},
+    'PS_LATENCY_MARGIN'     : {  'prec': 5},    # PS_LATENCY_SIGMAS * PS_LATENCY_STD, what a camera window needs beyond the x-ray pulse
+    'LIVE_SYNC'             : { }, # 1 starts live sync (Qi2 free running, CPI fired into its frames), 0 stops it
+    'LIVE_PHASE'            : { 'value': 0.005, # when the x-ray should start after the frame start (seconds)
+                                'prec': 4},
+    'LIVE_LEAD'             : { 'value': 0.015, # photospot to CPI expose latency, the photospot goes out this early
+                                'prec': 4},
+    'LIVE_LOCK_TOL'         : { 'value': 0.002, # frame edge to prediction error to count as locked (seconds)
+                                'prec': 4},
+    'LIVE_LOCKED'           : { 'type': 'enum',
+                                'enums': ['Unlocked', 'Locked']},
+    'LIVE_PERIOD'           : { 'prec': 5}, # estimated Qi2 frame period
+    'LIVE_PHASE_ERROR'      : { 'prec': 5}, # last frame start minus its prediction
+    'LIVE_XRAY_PHASE'       : { 'prec': 5}, # last CPI expose start minus its predicted frame start
+    'LIVE_SHOTS'            : { 'type': 'int' }, # photospot pulses fired in this live sync
+    'LIVE_MISSED'           : { 'type': 'int' }, # frames without an x-ray (skipped to catch up, or no expose out)
+    'LIVE_MISSED_EDGES'     : { 'type': 'int' }, # predicted frame starts that never came
     'SeqStarttoQi2'         : { },
     'TimeBetweenReq'        : { },
     'Qi2ReqToStart'         : { },
@@ -181,13 +283,61 @@ pvdb = {
     'CpiDuration'           : { },#'count': 1000 
     'DutyCycle'             : { }, 
     'ShotDuration'          : { },                    
+    'PrepToReady'           : { 'prec': 4},  # RAD_PREP request to generator exposure status
+    'PIPELINE'              : { 'value': 0 }, # release scan1.WAIT as soon as both exposures are over, bookkeeping overlaps the next move
+    'POINTS_PER_SEC'        : { 'prec': 3},   # scan points/s, from the time between consecutive scan1.WAIT releases
+    'GEN_READY_TIMEOUT'     : { 'value': 10.0, # seconds prepExpose waits for the generator exposure status
+                                'prec': 1},
+    'CHANGE_ONLY'           : { 'value': 1 }, # only publish *_RBV records when a polled line flips
+    'SUPPRESSED_UPDATES'    : { 'type': 'int' },
+    'DO_LATENCY'            : { 'prec': 6},      # queue to wire latency of the last DAQ output write
+    'DO_LATENCY_HIST'       : { 'type': 'int',
+                                'count': LATENCY_BUCKETS},
+    'DO_LATENCY_BINS'       : { 'type': 'float', # lower edge of each DO_LATENCY_HIST bucket (seconds)
+                                'count': LATENCY_BUCKETS},
+    'POLL_PROFILE_DUMP'     : { },   # write 1 to copy the poll loop histograms to POLL_*_HIST and print them
+    'POLL_PROFILE_RESET'    : { },   # write 1 to clear the poll loop histograms
+    'EDGE_LOG_COUNT'        : { 'type': 'int' }, # input edges logged since startup
+    'EDGE_LOG_OVERRUNS'     : { 'type': 'int' }, # edges overwritten before they reached the disk
+    'EDGE_LOG_FLUSH'        : { },   # write 1 to write the logged edges to disk now
+    'LOG_LEVEL'             : { 'type': 'enum', # DEBUG logs every edge and sequence step, INFO only sequences and status
+                                'enums': list(LEVEL_NAMES),
+                                'value': 0},
+    'PV_COUNT'              : { 'type': 'int' }, # PVs in the registry
+    'PV_CONNECTED'          : { 'type': 'int' }, # of them connected now
+    'PV_CONNECT_TIME'       : { 'prec': 4},      # startup wait for the PV connections (at most PV_CONNECT_TIMEOUT)
+    'PV_DISCONNECTED'       : { 'type': 'char',  # names of the PVs not connected now
+                                'count': 2000},
+    'CPU_PERCENT'           : { 'prec': 1}, # process CPU use (% of one core) over the last STATS_PERIOD
 }
 
+# rolling statistics and last TIMING_WINDOW shots of every timing record, updated by the timer wheel after new shots
+for reason in TIMING_RECORDS:
+    prec = pvdb.get(reason, {}).get('prec', 4) # the GEN_DELAY_* records need microseconds
+    pvdb[reason + '_WF'] = { 'count': TIMING_WINDOW,
+                             'prec': prec}
+    for stat in ('_MEAN', '_STD', '_MIN', '_MAX'):
+        pvdb[reason + stat] = { 'prec': prec}
+
+# poll loop period, DAQ read and publish time percentiles (histogram buckets are DO_LATENCY_BINS)
+for reason in POLL_STATS:
+    pvdb[reason] = { 'prec': 6}
+for part in LoopProfiler.PARTS:
+    pvdb['POLL_%s_HIST' % part.upper()] = { 'type': 'int',
+                                            'count': LATENCY_BUCKETS}
+
+# connection state and first connection latency (CONN_<pv>_TIME) of every PV in the registry
+PV_RECORDS = dict((name, 'CONN_' + re.sub(r'\W', '_', name)) for name in PVS.names())
+for reason in PV_RECORDS.values():
+    pvdb[reason] = { 'type': 'enum',
+                     'enums': ['Disconnected', 'Connected']}
+    pvdb[reason + '_TIME'] = { 'prec': 4}
+
 pvdb.update(epicsApps.pvdb)
 
 
 class myDriver(Driver):
-    def  __init__(self):
+    def  __init__(self, inputBackend=INPUT_BACKEND, reportFormats=REPORT_FORMATS):
         super(myDriver, self).__init__()
         self.start_time = datetime.now()
         self.iocStats()
@@ -195,14 +345,33 @@ class myDriver(Driver):
 
         self.lastCpiExposure = lastCpiExposure # keep track of most recent exposure
         self.cancel = 0 # cancel flag for abort procedure 
+        self.aborts = 0 # abort count, a sequence queued behind an abort sees it even after cancel is cleared again
         self.currentFunction = '' # initialize current function string used in status messages
         self.seqInProgress=0 # flag to determine if we are inside a "sequence" or not
-        # high speed scans
-        self.firstImageFlag=1
-        self.qi2EndFlag = False
+        # live sync: frame clock estimate from the Qi2 frame starts, fed by processInputs while liveSyncOn
+        self.framePll = FramePLL()
+        self.liveSyncOn = False
+        # latest line values for sequences to block on, notified by the input backend on every edge
+        #   (PHOTOSPOT and seqInProgress are fed by write/setSeqInProgress)
+        self.lineState = LineState(INPUT_RECORDS + ('PHOTOSPOT', 'seqInProgress'))
 
         # the following variable is needed for pydaqmx
         self.written = int32()
+        # number of poll passes where no line changed and publishing was skipped
+        self.suppressedUpdates = 0
+        # all DAQ output writes go through one ordered queue instead of a new thread per write
+        self.daqOut = OutputWorker()
+        self.setParam('DO_LATENCY_BINS', [0.0] + self.daqOut.histogram.edges)
+        # histograms of the poll loop period, DAQ read time and publish time
+        self.pollProfile = LoopProfiler()
+        # file writes (doc strings, timing reports) happen on this thread, never in the exposure path
+        self.fileJobs = JobQueue('fileWriter')
+        # CPU_PERCENT source
+        self.process = psutil.Process(os.getpid())
+        self.process.cpu_percent()
+        self.reportFormats = reportFormats
+        # hybrid sleep/spin timer for the Qi2 trigger to CPI photospot delay
+        self.genDelay = DelayScheduler(self.getParam('GEN_DELAY_SPIN'))
         
         #set up the warning sounds which will play out of computer speakers (needs to be unmuted)
         #self.PrepSound=False
@@ -210,6 +379,9 @@ class myDriver(Driver):
         #sid.start()
         
         #Setup DO lines
+        self.portTask = None
+        if PORT_OUTPUT:
+            self.setupPortOutput(OUTPUT_LINES)
         self.photospotInTask = TaskHandle()
         self.setupOutput(self.photospotInTask, CPI_PHOTOSPOT_IN, True)
         self.Qi2TriggerTask = TaskHandle()
@@ -224,16 +396,17 @@ class myDriver(Driver):
         self.setupOutput(self.exposeInTask, CPI_EXPOSE_IN, True)
         self.fluoroInTask = TaskHandle()
         self.setupOutput(self.fluoroInTask, CPI_FLUORO_IN, True)
-
-        #task to read DI lines combined into one (significantly improves performance to do one read)
-        self.combinedTask = TaskHandle()
-        DAQmxCreateTask("",byref(self.combinedTask))
-        DAQmxCreateDIChan(self.combinedTask, INPUT_POLL, "", DAQmx_Val_ChanForAllLines)
-        DAQmxStartTask(self.combinedTask)      
-
-        ##start the polling thread
-        self.cid = threading.Thread(target=self.pollInputs,args=())
-        self.cid.start()
+        # output records and their lines, for changing several at once with writeOutputs
+        self.outputTasks = {'PHOTOSPOT'   : self.photospotInTask,
+                            'SEND_TRIGGER': self.Qi2TriggerTask,
+                            'RAD_PREP'    : self.radPrepInTask,
+                            'EXPOSE'      : self.exposeInTask,
+                            'FLUORO'      : self.fluoroInTask}
+        self.outputLines = {'PHOTOSPOT'   : CPI_PHOTOSPOT_IN,
+                            'SEND_TRIGGER': QI2_EXPOSE,
+                            'RAD_PREP'    : CPI_RAD_PREP_IN,
+                            'EXPOSE'      : CPI_EXPOSE_IN,
+                            'FLUORO'      : CPI_FLUORO_IN}
 
         #timing
         self.prepTime=0
@@ -247,19 +420,30 @@ class myDriver(Driver):
         self.cpiExposeEndTime=0
         self.lastqi2ExposeEndTime=0
         self.scanExpEndTime=0
-        self.qi2DurationList = []
-        self.cpiDurationList = []
-        self.dutyCycleList = []
-        self.cpiRequestList = []
-        self.qi2RequestList = []
-        self.scanExpSeqList = []
+        self.lastReleaseTime=0
+        # LATENCY_MODEL key of the exposure in progress
+        self.exposureKey = (None, None, None)
+        # per shot timing of the current scan, one fixed size buffer with running statistics per timing record
+        self.timingStats = dict((reason, TimingBuffer(TIMING_CAPACITY)) for reason in TIMING_RECORDS)
+        self.timingDirty = dict((reason, False) for reason in TIMING_RECORDS) # new shots not yet in the window records
+        # every input edge (line, direction, timestamp), written to disk in bulk by the file writer
+        self.edgeLog = EdgeLog(os.path.join(EDGE_LOG_DIR, 'edges_' + time.strftime("%Y%m%d-%H%M%S")), INPUT_RECORDS, self.fileJobs)
+
+        #start watching the input lines (timing variables above must exist before the first edge)
+        self.setupInput(inputBackend)
+
+        # every PV has been connecting since import, wait for the stragglers once
+        self.connectPVs()
+
         # Set scan detector PV to NikonSync hard trigger PV on init.
         SCAN_DETECTOR_1.put(EXPERIMENT + 'cpiSync:NikonScanExposeSeq')
     #    epicsApps.buildRequestFiles(prefix, pvdb.keys(), os.getcwd())
     #    epicsApps.makeAutosaveFiles()
+        # LAST_EXPOSE_TIME_RBV, UPTIME... and the statistics records from now on
+        self.startTimers()
         #Now ready to do exposures, change from Initilization to Idle 
         self.write('STATUS_RBV', 'Idle')
-        print str(datetime.now())[:-3], 'cpiSync succesfully initialized'
+        LOG.info('cpiSync succesfully initialized')
 
     def iocStats(self):
         """
@@ -274,8 +458,42 @@ class myDriver(Driver):
         self.setParam('PARENT_ID', os.getpid())
         self.setParam('HEARTBEAT', 0)
 
+    def connectPVs(self):
+        """
+        Waits up to PV_CONNECT_TIMEOUT for the PV registry, then publishes and follows every PV connection state
+        """
+        start = monotonic()
+        missing = PVS.waitConnected(PV_CONNECT_TIMEOUT)
+        self.setParam('PV_CONNECT_TIME', monotonic() - start)
+        self.setParam('PV_COUNT', len(PV_RECORDS))
+        PVS.onConnection(self.pvConnection)
+        for name, connected, latency in PVS.status():
+            self.pvConnection(name, connected, latency)
+        if missing:
+            LOG.warning('%d of %d PVs not connected after %.1f s: %s', len(missing), len(PV_RECORDS),
+                        PV_CONNECT_TIMEOUT, ' '.join(missing))
+        else:
+            LOG.info('%d PVs connected in %.3f s', len(PV_RECORDS), self.getParam('PV_CONNECT_TIME'))
+
+    # PV registry connection callback (CA thread)
+    def pvConnection(self, name, connected, latency):
+        reason = PV_RECORDS.get(name)
+        if reason is None: # added after pvdb was built
+            return
+        self.setParam(reason, int(connected))
+        if latency is not None:
+            self.setParam(reason + '_TIME', latency)
+        missing = [n for n in PVS.missing() if n in PV_RECORDS]
+        self.setParam('PV_CONNECTED', len(PV_RECORDS) - len(missing))
+        self.setParam('PV_DISCONNECTED', ' '.join(missing))
+        self.updatePVs()
+
     #Generic function for setting up daq output
+    #   with the port task the line is only registered, it is already in the port task and low
     def setupOutput(self, taskName, lineLocation, setLow):
+        if self.portTask is not None:
+            self.portLines.append((taskName, lineLocation))
+            return
         DAQmxCreateTask("",byref(taskName))
         DAQmxCreateDOChan(taskName, lineLocation, "", DAQmx_Val_ChanForAllLines)
         DAQmxSetDOOutputDriveType(taskName, lineLocation, DAQmx_Val_ActiveDrive)
@@ -283,151 +501,241 @@ class myDriver(Driver):
         if setLow == True:
             self.setDigiOut(taskName, LOW)
 
+    #Set up one task for all output lines, a shadow copy of the lines lets us write one or many of them in one call
+    def setupPortOutput(self, lines):
+        self.portShadow = PortShadow(lines)
+        self.portLines = [] # (per line task handle, line name), ctypes task handles can't be dict keys
+        self.portTask = TaskHandle()
+        channels = ",".join(lines)
+        DAQmxCreateTask("",byref(self.portTask))
+        DAQmxCreateDOChan(self.portTask, channels, "", DAQmx_Val_ChanForAllLines)
+        DAQmxSetDOOutputDriveType(self.portTask, channels, DAQmx_Val_ActiveDrive)
+        DAQmxStartTask(self.portTask)
+        self.processDAQstatus(DAQmxWriteDigitalLines(self.portTask,1,1,10.0,DAQmx_Val_GroupByChannel, self.portShadow.values, self.written, None))
+
+    #Set up the task that reads all input lines at once (significantly improves performance to do one read)
+    #   and start the selected input backend. Both backends hand each new read of the lines to processInputs
+    #   -'poll':   a thread reads the lines as fast as it can (the ni daq 6501 doesnt support change detection)
+    #   -'change': DAQmx change detection calls DIChangeCallback on every edge, no thread spinning on the DAQ
+    def setupInput(self, backend):
+        self.combinedTask = TaskHandle()
+        DAQmxCreateTask("",byref(self.combinedTask))
+        DAQmxCreateDIChan(self.combinedTask, INPUT_POLL, "", DAQmx_Val_ChanForAllLines)
+        DAQmxStartTask(self.combinedTask)
+        #current state of the lines, publish everything once
+        self.inputValues = np.zeros((len(INPUT_RECORDS),), dtype=np.uint8)
+        DAQmxReadDigitalLines(self.combinedTask, 1, 1, 0, self.inputValues, len(INPUT_RECORDS), None, None, None)
+        self.inputWord = int(np.dot(self.inputValues, INPUT_BITS))
+        for i, record in enumerate(INPUT_RECORDS):
+            self.setParam(record, self.inputValues[i])
+        self.updatePVs()
+        self.lineState.update(dict(zip(INPUT_RECORDS, self.inputValues)))
+        if backend == 'change':
+            DAQmxStopTask(self.combinedTask)
+            #keep a reference to the callback pointer, otherwise it gets garbage collected
+            self._DIChangeCallback = DAQmxSignalEventCallbackPtr(self.DIChangeCallback)
+            DAQmxCfgChangeDetectionTiming(self.combinedTask, INPUT_POLL, INPUT_POLL, DAQmx_Val_ContSamps, 8)
+            DAQmxRegisterSignalEvent(self.combinedTask, DAQmx_Val_ChangeDetectionEvent, 0, self._DIChangeCallback, None)
+            DAQmxStartTask(self.combinedTask)
+        else:
+            ##start the polling thread
+            self.cid = threading.Thread(target=self.pollInputs,args=())
+            self.cid.start()
+        LOG.info('Input backend: %s', backend)
+
     #since the ni daq 6501 doesnt support change detection, we have to poll and do change detection ourselves
     def pollInputs(self):
-        oldval = np.array([0,0,0,0,0,0], dtype=np.uint8)
-        newval = np.array([0,0,0,0,0,0], dtype=np.uint8)
-        DAQmxReadDigitalLines(self.combinedTask, 1, 1, 0,  oldval, 6, None, None, None)
+        newval = np.zeros((len(INPUT_RECORDS),), dtype=np.uint8)
         while True:
-            startPollTime = time.clock()
+            startPollTime = monotonic()
             DAQmxReadDigitalLines(self.combinedTask, 1, 1, 0, newval, 6, None, None, None) 
-            #print newval
-            #print 'daqreadtime', time.clock() - startPollTime    
-            #setParamTime = time.clock()       
-            self.setParam("RAD_PREP_RBV",      newval[0])
-            self.setParam("RAD_READY_RBV",     newval[1])
-            self.setParam("EXPOSE_RBV",        newval[2])
-            self.setParam("FLUORO_RBV",        newval[3])
-            self.setParam("TRIGGER_READY_RBV", newval[4])
-            self.setParam("EXPOSING_RBV",      newval[5])
-            self.updatePVs()
-            #print 'updatePvTime', time.clock() - setParamTime          
-            #if np.all(np.sort(oldval)!=np.sort(newval)):
-            if newval[4] != oldval[4]:
-                if newval[4] == 1:
-                    print str(datetime.now())[:-3], 'Qi2 END EXPOSURE', '%.4f'%(time.clock()- self.scanExposeRequestTime)
-                    self.qi2ExposeEndTime=time.clock()
-                    #post exposure report
-                    #time from last exposure
-                    if self.lastqi2ExposeEndTime != 0:
-                        #print 'Time between qi2 expose end signal (exposure duty cycle)', self.qi2ExposeEndTime-self.lastqi2ExposeEndTime
-                        self.setParam('DutyCycle', self.qi2ExposeEndTime-self.lastqi2ExposeEndTime)
-                        self.dutyCycleList.append(self.qi2ExposeEndTime-self.lastqi2ExposeEndTime)
-                    #time from scan expose request to qi2 exp request
-                    #print 'Expose Request to Qi2 request', self.qi2ExposeReqeustTime-self.scanExposeRequestTime
-                    #time from qi2 exp request to cpi exp request
-                    #print 'Expose Qi2 Request to Cpi Request', self.cpiExposeRequestTime-self.qi2ExposeReqeustTime
-                    self.setParam('TimeBetweenReq',self.cpiExposeRequestTime-self.qi2ExposeReqeustTime)
-                    #time from qi2 request to qi2 start
-                    #print 'Qi2 Request to Qi2 Start', self.qi2ExposeStartTime -self.qi2ExposeReqeustTime
-                    self.setParam('Qi2ReqToStart',self.qi2ExposeStartTime -self.qi2ExposeReqeustTime)
-                    self.qi2RequestList.append(self.qi2ExposeStartTime -self.qi2ExposeReqeustTime)
-                    #time from cpi request to cpi start
-                    #print 'Cpi Request to Cpi Start', self.cpiExposeStartTime-self.cpiExposeRequestTime
-                    self.setParam('CpiReqToStart',self.cpiExposeStartTime-self.cpiExposeRequestTime)
-                    self.cpiRequestList.append(self.cpiExposeStartTime-self.cpiExposeRequestTime)
-                    #time from qi2 start to cpi start
-                    #print 'Cpi Start to Qi2 Start', self.cpiExposeStartTime-self.qi2ExposeStartTime
-                    self.setParam('CpiStarttoQi2Start',self.cpiExposeStartTime-self.qi2ExposeStartTime)
-                    #time from qi2 start to qi2 end
-                    #print 'Qi2 Start to Qi2 End', self.qi2ExposeEndTime-self.qi2ExposeStartTime
-                    self.setParam('Qi2Duration', self.qi2ExposeEndTime-self.qi2ExposeStartTime)
-                    self.qi2DurationList.append(self.qi2ExposeEndTime-self.qi2ExposeStartTime)
-                    #time from cpi start to cpi end
-                    #print 'Cpi Start to Cpi End', self.cpiExposeEndTime-self.cpiExposeStartTime
-                    #self.listTest.append((self.cpiExposeEndTime-self.cpiExposeStartTime))
-                    #self.setParam('CpiDuration', self.listTest)                   
-                    self.setParam('CpiDuration', self.cpiExposeEndTime-self.cpiExposeStartTime)
-                    self.cpiDurationList.append(self.cpiExposeEndTime-self.cpiExposeStartTime)
-                    self.lastqi2ExposeEndTime=self.qi2ExposeEndTime
-            if newval[5] != oldval[5]:
-                if newval[5] == 1:
-                    #print 'qi2 zero time ', time.clock()-self.qi2ExposeEndTime
-                    print str(datetime.now())[:-3], 'Qi2 START EXPOSURE', '%.4f'%(time.clock()- self.scanExposeRequestTime)
-                    self.qi2ExposeStartTime=time.clock()
-                else:
-                    self.write('SEND_TRIGGER',0)
-                    self.qi2EndFlag=True
-                    self.qi2ExposeEndTime=time.clock()
-                    print str(datetime.now())[:-3], 'Qi2 END EXPOSURE (LIVE)', '%.4f'%(time.clock()- self.scanExposeRequestTime)
-            #check cpi expose out
-            if newval[2] != oldval[2]:
-                if newval[2] == 1:
-                    print str(datetime.now())[:-3], 'GENERATOR RAD ENABLE', '%.4f'%(time.clock()- self.scanExposeRequestTime)
-                    self.cpiExposeStartTime=time.clock()
-                    print 'time between cpi exposures, ', self.cpiExposeStartTime - self.cpiExposeEndTime
-                else:
-                    self.write("PHOTOSPOT", 0)
-                    #if self.getParam("PHOTOSPOT")==1:
-                    #    self.write("PHOTOSPOT", 0)
-                    print str(datetime.now())[:-3], 'GENERATOR RAD END', '%.4f'%(time.clock()- self.scanExposeRequestTime)
-                    self.cpiExposeEndTime=time.clock()
-                    #only update lastcpiexposure if it was a real exposure (not toggle during cpi boot)
-                    #if RadReadyOut (newval[1]) is 1, then it probably was a real exposure
-                    if newval[1] == 1:
-                        self.lastCpiExposure = time.time()
-            self.updatePVs()
-            #Note: the below line is for storing the old value of array (before new read)
-            # it must use the copy method, otherwise it will access the location of the array
-            oldval = newval.copy()
-            endPollTime = time.clock()
+            readTime = monotonic()
+            self.processInputs(newval, readTime)
+            endPollTime = monotonic()
+            self.pollProfile.record(startPollTime, readTime, endPollTime)
             if endPollTime - startPollTime > 0.002:
-                print str(datetime.now())[:-3], 'DAQ Poll > 2 ms !', endPollTime - startPollTime
+                LOG.warning('DAQ Poll > 2 ms ! %s', endPollTime - startPollTime)
 
-    def read(self, reason):
-        format_time = ""
-        if reason == 'LAST_EXPOSE_TIME_RBV' :
-            secsSinceLastExposure = time.time() - self.lastCpiExposure
-            value = self.printNiceTimeDelta(secsSinceLastExposure)
-            if secsSinceLastExposure > 28800:
-                self.setParam('STATUS_RBV', 'More than 8 hours since last exposure- run warm-up')
-                self.updatePVs()
-        elif reason == 'UPTIME':
-            format_time = datetime.now() - self.start_time
-            value  = str(format_time).split(".")[0] 
-        elif reason == 'TOD':
-            value = str(datetime.now().strftime("%m/%d/%Y %H:%M:%S"))
-        elif reason == 'HEARTBEAT':
-            value = self.getParam('HEARTBEAT') + 1
-            self.setParam('HEARTBEAT', value)
+    #DAQmx change detection event, one sample is buffered per change
+    def DIChangeCallback(self, taskHandle, status, callbackData):
+        timestamp = monotonic()
+        newval = np.zeros((len(INPUT_RECORDS),), dtype=np.uint8)
+        DAQmxReadDigitalLines(self.combinedTask, 1, 1, 0, newval, 6, None, None, None)
+        self.processInputs(newval, timestamp)
+        return 0 # DAQMX requires callback function to return an integer
+
+    #Handle a new read of the input lines taken at timestamp (from either input backend)
+    #   the lines are packed into one word so an unchanged read costs one integer compare,
+    #   and only the records of lines that flipped are pushed to pcaspy (unless CHANGE_ONLY is 0)
+    def processInputs(self, newval, timestamp):
+        newword = int(np.dot(newval, INPUT_BITS))
+        if self.getParam('CHANGE_ONLY') == 1:
+            changed = newword ^ self.inputWord
         else:
-            value = self.getParam(reason)
+            changed = (1 << len(INPUT_RECORDS)) - 1
+        if changed == 0:
+            self.suppressedUpdates += 1
+            return
+        self.edgeLog.record(newword ^ self.inputWord, newword, timestamp)
+        for i, record in enumerate(INPUT_RECORDS):
+            if changed >> i & 1:
+                self.setParam(record, newval[i])
+        #if np.all(np.sort(oldval)!=np.sort(newval)):
+        if newval[4] != self.inputValues[4]:
+            if newval[4] == 1:
+                LOG.debug('Qi2 END EXPOSURE %.4f', timestamp - self.scanExposeRequestTime)
+                self.qi2ExposeEndTime=timestamp
+                #post exposure report
+                #time from last exposure
+                if self.lastqi2ExposeEndTime != 0:
+                    #print 'Time between qi2 expose end signal (exposure duty cycle)', self.qi2ExposeEndTime-self.lastqi2ExposeEndTime
+                    self.recordTiming('DutyCycle', self.qi2ExposeEndTime-self.lastqi2ExposeEndTime)
+                #time from scan expose request to qi2 exp request
+                #print 'Expose Request to Qi2 request', self.qi2ExposeReqeustTime-self.scanExposeRequestTime
+                #time from qi2 exp request to cpi exp request
+                #print 'Expose Qi2 Request to Cpi Request', self.cpiExposeRequestTime-self.qi2ExposeReqeustTime
+                self.recordTiming('TimeBetweenReq',self.cpiExposeRequestTime-self.qi2ExposeReqeustTime)
+                #time from qi2 request to qi2 start
+                #print 'Qi2 Request to Qi2 Start', self.qi2ExposeStartTime -self.qi2ExposeReqeustTime
+                self.recordTiming('Qi2ReqToStart',self.qi2ExposeStartTime -self.qi2ExposeReqeustTime)
+                #time from cpi request to cpi start
+                #print 'Cpi Request to Cpi Start', self.cpiExposeStartTime-self.cpiExposeRequestTime
+                self.recordTiming('CpiReqToStart',self.cpiExposeStartTime-self.cpiExposeRequestTime)
+                #time from qi2 start to cpi start
+                #print 'Cpi Start to Qi2 Start', self.cpiExposeStartTime-self.qi2ExposeStartTime
+                self.recordTiming('CpiStarttoQi2Start',self.cpiExposeStartTime-self.qi2ExposeStartTime)
+                #time from qi2 start to qi2 end
+                #print 'Qi2 Start to Qi2 End', self.qi2ExposeEndTime-self.qi2ExposeStartTime
+                self.recordTiming('Qi2Duration', self.qi2ExposeEndTime-self.qi2ExposeStartTime)
+                #time from cpi start to cpi end
+                #print 'Cpi Start to Cpi End', self.cpiExposeEndTime-self.cpiExposeStartTime
+                #self.listTest.append((self.cpiExposeEndTime-self.cpiExposeStartTime))
+                #self.setParam('CpiDuration', self.listTest)                   
+                self.recordTiming('CpiDuration', self.cpiExposeEndTime-self.cpiExposeStartTime)
+                self.lastqi2ExposeEndTime=self.qi2ExposeEndTime
+        if newval[5] != self.inputValues[5]:
+            if newval[5] == 1:
+                #print 'qi2 zero time ', monotonic()-self.qi2ExposeEndTime
+                LOG.debug('Qi2 START EXPOSURE %.4f', timestamp - self.scanExposeRequestTime)
+                self.qi2ExposeStartTime=timestamp
+                if self.liveSyncOn:
+                    self.framePll.edge(timestamp)
+            else:
+                self.write('SEND_TRIGGER',0)
+                self.qi2ExposeEndTime=timestamp
+                LOG.debug('Qi2 END EXPOSURE (LIVE) %.4f', timestamp - self.scanExposeRequestTime)
+        #check cpi expose out
+        if newval[2] != self.inputValues[2]:
+            if newval[2] == 1:
+                LOG.debug('GENERATOR RAD ENABLE %.4f', timestamp - self.scanExposeRequestTime)
+                self.cpiExposeStartTime=timestamp
+                LOG.debug('time between cpi exposures, %s', self.cpiExposeStartTime - self.cpiExposeEndTime)
+                if self.cpiExposeRequestTime > self.cpiExposeEndTime: # a photospot request is waiting for this edge
+                    LATENCY_MODEL.add(self.exposureKey, timestamp - self.cpiExposeRequestTime)
+            else:
+                self.write("PHOTOSPOT", 0)
+                #if self.getParam("PHOTOSPOT")==1:
+                #    self.write("PHOTOSPOT", 0)
+                LOG.debug('GENERATOR RAD END %.4f', timestamp - self.scanExposeRequestTime)
+                self.cpiExposeEndTime=timestamp
+                #only update lastcpiexposure if it was a real exposure (not toggle during cpi boot)
+                #if RadReadyOut (newval[1]) is 1, then it probably was a real exposure
+                if newval[1] == 1:
+                    self.lastCpiExposure = time.time()
         self.updatePVs()
-        return value
+        #Note: the below line is for storing the old value of array (before new read)
+        # it must use the copy method, otherwise it will access the location of the array
+        self.inputValues = newval.copy()
+        self.inputWord = newword
+        #wake any sequence waiting on these lines
+        self.lineState.update(dict((record, self.inputValues[i]) for i, record in enumerate(INPUT_RECORDS) if changed >> i & 1))
+
+    def read(self, reason):
+        # periodic records are kept current by the timer wheel (see startTimers), reading is only a param lookup
+        return self.getParam(reason)
+
+    #Timer wheel callbacks, each sets its records and the wheel calls updatePVs once per tick
+    def startTimers(self):
+        self.timers = TimerWheel('periodicRecords', after=self.updatePVs)
+        self.timers.every(LAST_EXPOSE_PERIOD, self.updateLastExposeTime)
+        self.timers.every(CLOCK_PERIOD, self.updateClock)
+        self.timers.every(CALIBRATE_PERIOD, calibrate)
+        self.timers.every(STATS_PERIOD, self.updateStats)
+        self.timers.every(STATS_PERIOD, self.saveLatencyModel)
+        self.timers.every(TIMING_STATS_PERIOD, self.updateTimingStats)
+
+    def updateLastExposeTime(self):
+        secsSinceLastExposure = time.time() - self.lastCpiExposure
+        self.setParam('LAST_EXPOSE_TIME_RBV', self.printNiceTimeDelta(secsSinceLastExposure))
+        if secsSinceLastExposure > 28800:
+            self.setParam('STATUS_RBV', 'More than 8 hours since last exposure- run warm-up')
+
+    def updateClock(self):
+        now = datetime.now()
+        self.setParam('UPTIME', str(now - self.start_time).split(".")[0])
+        self.setParam('TOD', now.strftime("%m/%d/%Y %H:%M:%S"))
+        self.setParam('HEARTBEAT', self.getParam('HEARTBEAT') + 1)
+
+    def updateStats(self):
+        self.setParam('SUPPRESSED_UPDATES', self.suppressedUpdates)
+        self.setParam('DO_LATENCY', self.daqOut.lastLatency)
+        self.setParam('DO_LATENCY_HIST', list(self.daqOut.histogram.counts))
+        for reason, (part, index) in POLL_STATS.items():
+            self.setParam(reason, self.pollProfile.summary(part)[index])
+        self.setParam('EDGE_LOG_COUNT', self.edgeLog.count)
+        self.setParam('EDGE_LOG_OVERRUNS', self.edgeLog.overruns)
+        self.setParam('CPU_PERCENT', self.process.cpu_percent())
+
+    #publish the latency model for the current setting and queue it for saving, if there were new shots
+    def saveLatencyModel(self):
+        if not LATENCY_MODEL.changed:
+            return
+        LATENCY_MODEL.changed = False
+        LATENCY_STORE.set(LATENCY_MODEL.state())
+        count, mean, std = LATENCY_MODEL.estimate(self.exposureKey)
+        self.setParam('PS_LATENCY', LATENCY_MODEL.last)
+        self.setParam('PS_LATENCY_MEAN', mean)
+        self.setParam('PS_LATENCY_STD', std)
+        self.setParam('PS_LATENCY_COUNT', LATENCY_MODEL.stats.get(self.exposureKey, (0,))[0])
+        self.setParam('PS_LATENCY_MARGIN', self.getParam('PS_LATENCY_SIGMAS') * std)
+
+    #LATENCY_MODEL key of the current generator setting (monitored setpoints, no CA round trip)
+    def generatorSetting(self):
+        kvp, current, focus = CPI_KVP_PV.get(), CPI_MA_PV.get(), CPI_SETFOCUS_PV.get()
+        return (None if kvp is None else int(round(kvp)), None if current is None else round(current, 1), focus)
+
+    #how early the photospot must go out for the x-ray to start on time: the learned latency
+    #   with PREDICTIVE_TRIGGER on, else the fixed default
+    def photospotLead(self, default):
+        if self.getParam('PREDICTIVE_TRIGGER') == 1:
+            return LATENCY_MODEL.predict(self.exposureKey, default)
+        return default
 
     def write(self, reason, value):
         self.setParam(reason, value)
         self.updatePVs()
+        if reason == 'PHOTOSPOT':
+            self.lineState.update({reason: value})
         if  reason == 'RAD_PREP':
-            if value == 1:
-                self.did = threading.Thread(target = self.RadPrepOn, args = ())
-                self.did.start()
-            else:
-                self.did = threading.Thread(target = self.RadPrepOff, args = ())
-                self.did.start()
+            self.daqOut.put(self.setDigiOut, self.radPrepInTask, value)
             if self.seqInProgress == 0 and self.cancel == 0:
                 self.currentFunction = '(Manual)'    
         elif reason == 'EXPOSE':
             if (self.getParam("RAD_PREP_RBV") == 1 and value == 1 ) or value == 0:
-                self.did = threading.Thread(target = self.setDigiOut, args = (self.exposeInTask, value))
-                self.did.start()
+                self.daqOut.put(self.setDigiOut, self.exposeInTask, value)
                 if value == 0:
-                    with open('objs.pickle', 'w') as f:
-                        pickle.dump(self.lastCpiExposure, f)
+                    self.saveLastExposure()
                 if self.seqInProgress == 0 and self.cancel == 0:
                     self.currentFunction = '(Manual)'
         elif reason == 'FLUORO':
-            self.zid = threading.Thread(target = self.setDigiOut, args = (self.fluoroInTask, value))
-            self.zid.start()
+            self.daqOut.put(self.setDigiOut, self.fluoroInTask, value)
             if self.seqInProgress == 0 and self.cancel == 0:
                 self.currentFunction = '(Manual)'
         elif reason == 'PHOTOSPOT':
-            self.mid = threading.Thread(target = self.setDigiOut, args = (self.photospotInTask, value))
-            self.mid.start()
+            self.daqOut.put(self.setDigiOut, self.photospotInTask, value)
         elif reason == 'SEND_TRIGGER':
-            self.niTriggerTime=time.clock()
-            self.fid = threading.Thread(target = self.setDigiOut, args = (self.Qi2TriggerTask, value))
-            self.fid.start()
+            self.niTriggerTime=monotonic()
+            self.daqOut.put(self.setDigiOut, self.Qi2TriggerTask, value)
         elif reason == 'ON' and value == 1:
             self.eid = threading.Thread(target = self.On, args = ())
             self.eid.start()
@@ -435,8 +743,8 @@ class myDriver(Driver):
             self.fid = threading.Thread(target = self.Off, args = ())
             self.fid.start()
         elif reason == 'NikonSingleExposeSeq' and value == 1:
-            print str(datetime.now())[:-3],'SingleExpose requested 0.0000'
-            self.scanExposeRequestTime=time.clock()
+            LOG.debug('SingleExpose requested 0.0000')
+            self.scanExposeRequestTime=monotonic()
             #if Qi2 trigger isn't ready the user likely forgot to enable collection on Qi2
             # otherwise may be a problem with the Qi2 
             if self.getParam('TRIGGER_READY_RBV')==1:
@@ -446,8 +754,8 @@ class myDriver(Driver):
             else:               
                 self.write('STATUS_RBV',  'Error, Qi2 not ready to expose. ')
         elif reason == 'NikonScanExposeSeq' and value == 1:
-            print str(datetime.now())[:-3],'ScanExpose requested 0.0000'
-            self.scanExposeRequestTime=time.clock()
+            LOG.debug('ScanExpose requested 0.0000')
+            self.scanExposeRequestTime=monotonic()
             #self.NikonScanExposeSeq()
             self.fid = threading.Thread(target = self.NikonScanExposeSeq, args = ())
             self.fid.start()
@@ -459,44 +767,114 @@ class myDriver(Driver):
         elif reason == 'FULL_WARM' and value == 1:
             self.fid = threading.Thread(target = self.GenWarmUpSeqFull, args = ())
             self.fid.start()
-        elif reason == 'HighSpeedCpiTest' and value == 1:
-            self.fid = threading.Thread(target = self.liveSync, args = ()) 
-            self.fid.start()
+        elif reason == 'LIVE_SYNC':
+            if value == 1 and not self.liveSyncOn:
+                self.liveSyncOn = True # here, so a second LIVE_SYNC 1 can't start another loop before this one runs
+                self.fid = threading.Thread(target = self.liveSync, args = ())
+                self.fid.start()
+            elif value == 0:
+                self.lineState.wake() # liveSync re-checks LIVE_SYNC
         elif reason == 'ABORT' and value == 1:
             self.fid = threading.Thread(target = self.abort, args = ())
             self.fid.start()
+        elif reason == 'POLL_PROFILE_DUMP' and value == 1:
+            self.dumpPollProfile()
+        elif reason == 'POLL_PROFILE_RESET' and value == 1:
+            self.pollProfile.reset()
+        elif reason == 'EDGE_LOG_FLUSH' and value == 1:
+            self.edgeLog.queueFlush()
+        elif reason == 'LOG_LEVEL':
+            LOG.setLevel(LEVEL_NAMES[value])
         elif reason == 'STATUS_RBV':
-            print str(datetime.now())[:-3], value
+            LOG.info(value)
+        self.updatePVs()
+
+    #Change several output records at once, changes is a sequence of (record, value) written in that order (a tuple,
+    #   queued as is). All lines go out in one queued write (one USB transaction when using the port task).
+    #   Used where lines drop together: abort, end of exposure
+    def writeOutputs(self, changes):
+        for reason, value in changes:
+            self.setParam(reason, value)
+            if reason == 'PHOTOSPOT':
+                self.lineState.update({'PHOTOSPOT': value})
+        self.updatePVs()
+        self.daqOut.put(self.setDigiOutLines, changes)
+        if ('EXPOSE', 0) in changes:
+            self.saveLastExposure()
+
+    #copy the full poll loop histograms to the POLL_*_HIST records and print them
+    def dumpPollProfile(self):
+        for part in LoopProfiler.PARTS:
+            self.setParam('POLL_%s_HIST' % part.upper(), list(self.pollProfile.histograms[part].counts))
         self.updatePVs()
+        LOG.info('Poll loop profile\n%s', self.pollProfile.dump())
+
+    #publish a per shot timing record and add it to the scan statistics, called from the poll thread so it only
+    #  appends, the timer wheel publishes the rolling window records (updateTimingStats)
+    def recordTiming(self, reason, value):
+        self.setParam(reason, value)
+        self.timingStats[reason].add(value)
+        self.timingDirty[reason] = True
+
+    def updateTimingStats(self):
+        for reason in TIMING_RECORDS:
+            if not self.timingDirty[reason]:
+                continue
+            # cleared before reading, a shot added meanwhile is either in this window or flags it again
+            self.timingDirty[reason] = False
+            buf = self.timingStats[reason]
+            mean, std, low, high = buf.windowStats(TIMING_WINDOW)
+            self.setParam(reason + '_MEAN', mean)
+            self.setParam(reason + '_STD', std)
+            self.setParam(reason + '_MIN', low)
+            self.setParam(reason + '_MAX', high)
+            self.setParam(reason + '_WF', buf.last(TIMING_WINDOW)['value'].tolist())
+
+    #sequences call this when they start/finish so abort can wait for them
+    def setSeqInProgress(self, value):
+        self.seqInProgress = value
+        self.lineState.update({'seqInProgress': value})
+
+    #cancel test for lineState waits
+    def isCancelled(self):
+        return self.cancel == 1
+
+    #keep last exposure time on disk so we know when warmup is required after a restart
+    def saveLastExposure(self):
+        LAST_EXPOSURE_STORE.set(self.lastCpiExposure)
 
+    #Snapshot the doc PVs (cached monitor values, no CA round trips) and hand the file write to the file writer thread
     def document(self):
-        print str(datetime.now())[:-3],'Generate Doc String Start'
+        LOG.debug('Generate Doc String Start')
         pathname = self.filepath + '\\' + self.filename + '_' + str(self.filenum).zfill(3)
+        lines = [pvName + ' - ' + str(value) + '\n' for pvName, value in DOC_PVS.snapshot()]
+        self.fileJobs.put(self.writeDocFile, pathname + '.txt', lines)
+
+    def writeDocFile(self, filename, lines):
         try:
-            f = open(pathname + '.txt', 'w')
-            for pvName in PV_LIST:
-                f.write(pvName + ' - ' + str(caget(pvName)) + '\n')
-            print str(datetime.now())[:-3],'Generate Doc String Finish'
-        except:
-            print str(datetime.now())[:-3], "Error writing doc string", Exception
+            with open(filename, 'w') as f:
+                f.writelines(lines)
+            LOG.debug('Generate Doc String Finish')
+        except Exception as e:
+            LOG.error('Error writing doc string %s', e)
 
     def GenWarmUpSeq(self):
         self.currentFunction = '(Gen. Warm-Up)'
-        print str(datetime.now())[:-3], '!!!!! Short GenWarmUp Sequence Start !!!!!'
-        self.seqInProgress=1
+        LOG.info('!!!!! Short GenWarmUp Sequence Start !!!!!')
+        self.setSeqInProgress(1)
         self.GenExposeOnly(80,  25, 100, 3, 1)
         time.sleep(1)
         self.GenExposeOnly(100, 25, 100, 3, 1)
         time.sleep(1)
         self.GenExposeOnly(125, 25, 100, 3, 1)
-        self.seqInProgress=0
+        self.setSeqInProgress(0)
         if self.cancel == 0 :
             self.write('STATUS_RBV', self.currentFunction + 'Complete')
 
     def GenWarmUpSeqFull(self):
         self.currentFunction = '(Full Gen. Warm-Up)'
-        print str(datetime.now())[:-3], '!!!!! Full GenWarmUp Sequence Start !!!!!'
-        self.seqInProgress=1
+        LOG.info('!!!!! Full GenWarmUp Sequence Start !!!!!')
+        self.setSeqInProgress(1)
         CPI_SETFOCUS_PV.put(1, wait=True) #set focus to large    
         self.GenExposeOnly(80,  200, 2000, 6, 5)
         if self.cancel == 0:
@@ -512,7 +890,7 @@ class myDriver(Driver):
             time.sleep(1)
         self.GenExposeOnly(120,  320, 100, 3, 1)
         CPI_SETFOCUS_PV.put(0, wait=True) #set focus back to small
-        self.seqInProgress=0
+        self.setSeqInProgress(0)
         if self.cancel == 0:
             self.write('STATUS_RBV', self.currentFunction + 'Complete')
 
@@ -526,101 +904,104 @@ class myDriver(Driver):
             CPI_MS_PV.put(millisec, wait=True) 
             time.sleep(.1)
             self.prepExpose() # returns when ready to expose
+            # warm-up shots train the latency model too, under the setting they were taken at
+            self.exposureKey = self.generatorSetting()
             for count in range(0, numberOfExposures):
                 if self.cancel == 1:
                     break
                 # send trigger signal to CPI expose
                 self.write('STATUS_RBV', self.currentFunction + ' EXPOSING!')
+                self.cpiExposeRequestTime = monotonic()
                 self.write('PHOTOSPOT', 1)
                 # wait for exposure to finish
-                while self.getParam('PHOTOSPOT') == 1 and self.cancel == 0:
-                    time.sleep(POLL_TIME)
+                self.lineState.waitFor('PHOTOSPOT', 0, cancel=self.isCancelled)
                 #self.write('PHOTOSPOT', 0)
                 self.write('STATUS_RBV', self.currentFunction + ' wait duty cycle')
                 if self.cancel == 1:
                     break
                 time.sleep(dutyCycle)
             if self.cancel == 0:
-                self.write('EXPOSE',0)
-                self.write('RAD_PREP',0)
+                self.writeOutputs(EXPOSURE_OFF)
                 # wait for rad prep to turn off
-                while self.getParam('RAD_READY_RBV') == 1:
-                    time.sleep(POLL_TIME)
+                self.lineState.waitFor('RAD_READY_RBV', 0)
 
     #Take single isolated Nikon-CPI sync shot
     def NikonSingleExposeSeq(self):
         self.currentFunction = '(Nikon Single Shot)'
-        print str(datetime.now())[:-3], '!!!!! Nikon - CPI Single Shot Sequence Start !!!!!'
-        self.seqInProgress=1 #let abort sequence know this function is in progress
+        LOG.info('!!!!! Nikon - CPI Single Shot Sequence Start !!!!!')
+        self.setSeqInProgress(1) #let abort sequence know this function is in progress
         self.prepExpose()         #do chores and prepare gen (during this time camera has more time to prepare)
         self.checkIfCameraReady() # see if camera is actually ready to acquire
         self.exposeNow()          #send trigger signals, returns when exposure is over
         self.exposeEnd()          #resets nikon trigger, turns off cpi expose signal
         if self.cancel == 0 :   #if canceled rad prep is already off and we don't want status to be idle
-            self.write('RAD_PREP',0)   #single expose, so turn RadPrep off
-            self.write("EXPOSE",0)
+            self.writeOutputs(EXPOSURE_OFF)   #single expose, so turn RadPrep off
             self.write('STATUS_RBV', 'Idle')
-        if caget(SCAN_IOC + "scan1.P1PV") == XRAY_IOC + "SetKVP":
-            caput(SCAN_IOC + '.WAIT', 0) #tell scan we're finished acquiring the image and it can progress
-        self.seqInProgress=0 #let abort sequence know this function is over
-        print str(datetime.now())[:-3], '!!!!! Nikon - CPI Single Shot Sequence Over !!!!!'
+        if SCAN_STATE.get('P1PV') == XRAY_IOC + "SetKVP":
+            SCAN_KVP_WAIT_PV.put(0) #tell scan we're finished acquiring the image and it can progress
+        self.setSeqInProgress(0) #let abort sequence know this function is over
+        LOG.info('!!!!! Nikon - CPI Single Shot Sequence Over !!!!!')
 
     #Take Nikon-CPI sync shot during a scan
     # ideally we will have the scan performing its next move while various nikon-cpi sync chores are also taking place
     def NikonScanExposeSeq(self):
         self.currentFunction = '(Nikon Scan Shot)'
-        print str(datetime.now())[:-3], '!!!!! Nikon - CPI Single Scan Shot Sequence Start !!!!!'
-        self.seqInProgress=1 #let abort sequence know this function is in progress
+        LOG.info('!!!!! Nikon - CPI Single Scan Shot Sequence Start !!!!!')
+        # in pipelined mode the previous point may still be doing its bookkeeping, let it finish first
+        #   (it overlapped the motor move, so this normally returns immediately)
+        aborts = self.aborts
+        if not self.lineState.waitFor('seqInProgress', 0, timeout=SEQ_WAIT_TIMEOUT, cancel=self.isCancelled):
+            if self.cancel == 0:
+                LOG.error('Scan shot: previous point still in progress after %g s, point skipped', SEQ_WAIT_TIMEOUT)
+                self.write('STATUS_RBV', self.currentFunction + ' ERROR: previous point did not finish')
+            return
+        if self.cancel == 1 or self.aborts != aborts:
+            LOG.info('Scan shot cancelled before it started')
+            return
+        self.setSeqInProgress(1) #let abort sequence know this function is in progress
         self.prepExpose() #do chores and prepare gen (do nothing if gen is already ready)
         self.checkIfCameraReady() #chores finished, see if camera is actually ready
         self.exposeNow() #Returns when exposure is over
-        self.exposeEnd()
-        self.scanExpEndTime=time.clock()
+        pipeline = self.getParam('PIPELINE') == 1
+        if not pipeline:
+            self.exposeEnd()
+        self.scanExpEndTime=monotonic()
         if self.prepTime == 0:
-            self.scanExpSeqList.append(time.clock()-self.scanExposeRequestTime)
-            self.setParam('ShotDuration', self.scanExpEndTime -self.scanExposeRequestTime)
+            self.recordTiming('ShotDuration', self.scanExpEndTime -self.scanExposeRequestTime)
         else:
-            self.setParam('ShotDuration', (self.scanExpEndTime-self.scanExposeRequestTime)-self.prepTime) 
-            self.scanExpSeqList.append(time.clock()-self.scanExposeRequestTime-self.prepTime)
+            self.recordTiming('ShotDuration', (self.scanExpEndTime-self.scanExposeRequestTime)-self.prepTime) 
             self.prepTime=0
-        if self.cancel == 0:
-            #check if this was the last shot of the scan
-            #if caget(SCANPROGRESSIOC+'Nfinished') + 1 == caget(SCANPROGRESSIOC +'Ntotal') or caget(SCAN_IOC + '.CPT') + 1 == caget(SCAN_IOC + '.NPTS'): #just took last image, so turn off radprep
-            if NFINISHED_PV.get() + 1 == NTOTAL_PV.get() or CPT_PV.get() + 1 == NPTS_PV.get():             
-                print str(datetime.now())[:-3], "RadPrep turning off!"
-                self.write('RAD_PREP',0)
-                self.write("EXPOSE",0)
-                self.write('STATUS_RBV', 'Idle')
-                #print post scan timing report
-                reportfilename= self.filepath + '\\' + self.filename + '_Timing_'+time.strftime("%Y%m%d-%H%M%S")+ '.txt'
-                f1=open(reportfilename, 'w+')
-                #print 'qi2 duration num mean stddev min max',len(self.qi2DurationList), np.mean(self.qi2DurationList), np.nanstd(self.qi2DurationList), np.amin(self.qi2DurationList), np.amax(self.qi2DurationList)
-                #print 'cpi duration num mean stddev min max',len(self.cpiDurationList), np.mean(self.cpiDurationList), np.nanstd(self.cpiDurationList), np.amin(self.cpiDurationList), np.amax(self.cpiDurationList)
-                #print 'dutycycle num mean stddev min max',len(self.dutyCycleList), np.mean(self.dutyCycleList), np.nanstd(self.dutyCycleList), np.amin(self.dutyCycleList), np.amax(self.dutyCycleList)
-                f1.write('CPI-Qi2 Scan Time Report\n')
-                f1.write('Scan duration ' + str((time.clock()-self.scanStartTime)) + '\n')
-                f1.write('Prep Time ' + str(self.prepTime) + '\n')
-                f1.write('Number of points ' + str(NPTS_PV.get()) + '\n')
-                f1.write('Points/Duration ("FPS") '+ str(((time.clock()-self.scanStartTime)-self.prepTime)/NPTS_PV.get()) + '\n')
-                #f1.write('Time lost to scan motors/scan processing ', str(  )  )
-                f1.write('qi2 duration num mean stddev min max ' + str(len(self.qi2DurationList)) + ' ' + str(np.mean(self.qi2DurationList)) + ' ' + str(np.nanstd(self.qi2DurationList)) + ' ' + str(np.amin(self.qi2DurationList)) + ' ' + str(np.amax(self.qi2DurationList)) + '\n')
-                f1.write('cpi duration num mean stddev min max  '+str(len(self.cpiDurationList)) + ' ' + str(np.mean(self.cpiDurationList)) + ' ' + str(np.nanstd(self.cpiDurationList))+ ' ' + str(np.amin(self.cpiDurationList))+ ' ' +  str(np.amax(self.cpiDurationList))+ '\n')
-                f1.write('dutycycle num mean stddev min max  '+ str(len(self.dutyCycleList))+ ' ' + str(np.mean(self.dutyCycleList))+ ' ' + str( np.nanstd(self.dutyCycleList)) + ' ' + str(np.amin(self.dutyCycleList))+ ' ' + str(np.amax(self.dutyCycleList))+ '\n')
-                f1.write('single shot length num mean stddev min max  '+ str(len(self.scanExpSeqList))+ ' ' + str(np.mean(self.scanExpSeqList))+ ' ' + str( np.nanstd(self.scanExpSeqList)) + ' ' + str(np.amin(self.scanExpSeqList))+ ' ' + str(np.amax(self.scanExpSeqList))+ '\n')
-                f1.close()
-                self.scanExpSeqList = []
-                self.qi2DurationList = []
-                self.cpiDurationList = []
-                self.dutyCycleList = []
-                self.cpiRequestList = []
-                self.qi2RequestList = []
-            else:
-                self.write('STATUS_RBV', self.currentFunction + ' Wait sscan ')
-        if self.cancel == 0:
-            caput(SCAN_IOC + 'scan1.WAIT', 0) # tell scan we're finished acquiring the image and it can progress
-        self.seqInProgress=0 # let abort sequence know this function is over
+        #check if this was the last shot of the scan (must be read before the scan is released and moves on)
+        #if caget(SCANPROGRESSIOC+'Nfinished') + 1 == caget(SCANPROGRESSIOC +'Ntotal') or caget(SCAN_IOC + '.CPT') + 1 == caget(SCAN_IOC + '.NPTS'): #just took last image, so turn off radprep
+        lastPoint = SCAN_STATE.isLastPoint()
+        if self.cancel == 0 and not lastPoint:
+            # before the release, so it can't overwrite the status of the next point
+            self.write('STATUS_RBV', self.currentFunction + ' Wait sscan ')
+        if pipeline:
+            # both exposures are over, let the scan move on while the bookkeeping below runs
+            self.releaseScanPoint()
+            self.exposeEnd()
+        if self.cancel == 0 and lastPoint:
+            LOG.info('RadPrep turning off!')
+            self.writeOutputs(EXPOSURE_OFF)
+            self.write('STATUS_RBV', 'Idle')
+            #post scan timing report, snapshot the timing data here and write the files in the background
+            self.queueScanReport()
+        if not pipeline:
+            self.releaseScanPoint()
+        self.setSeqInProgress(0) # let abort sequence know this function is over
+
+        LOG.info('!!!!! Nikon - CPI Single Scan Shot Sequence Over !!!!!')
 
-        print str(datetime.now())[:-3], '!!!!! Nikon - CPI Single Scan Shot Sequence Over !!!!!'
+    #tell scan we're finished acquiring the image and it can progress, and update the scan point rate
+    def releaseScanPoint(self):
+        if self.cancel == 0:
+            SCAN_WAIT_PV.put(0)
+            now = monotonic()
+            if self.lastReleaseTime != 0 and now > self.lastReleaseTime:
+                self.setParam('POINTS_PER_SEC', 1.0 / (now - self.lastReleaseTime))
+            self.lastReleaseTime = now
+            self.updatePVs()
 
     #Checks if gen is ready to expose, if not prepares generator for an exposure, otherwise return
     #   function should only ever run at the beginning of a single shot OR a scan, never in the middle
@@ -629,265 +1010,187 @@ class myDriver(Driver):
     def prepExpose(self):
         if self.getParam('RAD_READY_RBV') == 0 and self.cancel == 0:
             self.lastqi2ExposeEndTime=0
-            self.scanStartTime=time.clock()
-            #ENABLE RAD PREP          
-            self.write('RAD_PREP', 1) #sets rad prep in to CPI to 1
+            self.lastReleaseTime=0
+            self.scanStartTime=monotonic()
+            #ENABLE RAD PREP, after RAD_PREP_DELAY (taken here, the DAQ output worker must not sleep), unless aborted meanwhile
+            if self.lineState.pause(RAD_PREP_DELAY, cancel=self.isCancelled):
+                self.write('RAD_PREP', 1) #sets rad prep in to CPI to 1
             self.write('STATUS_RBV', self.currentFunction + ' Wait RadReady')
             #Signal is sent to radprep, will take a few seconds, so do housekeeping-
             #   -grab info for doc string, filenum will change during scan so we will increment it later
             self.filepath=FILEPATH_PV.char_value
             self.filename=FILENAME_PV.char_value
-            self.filenum=caget(DET_IOC + 'TIFF1:FileNumber')
+            self.filenum=FILENUMBER_PV.get()
             self.docmode=self.getParam('DOC')
-            while self.getParam('RAD_READY_RBV') == 0 and self.cancel == 0:
-                time.sleep(POLL_TIME)
+            self.lineState.waitFor('RAD_READY_RBV', 1, cancel=self.isCancelled)
             #ENABLE PHOTOSPOT 
             self.write("EXPOSE", 1) #request for photospot
-            print str(datetime.now())[:-3], 'Wait for generator serial confirmation of Exposure Status'
-            while caget(XRAY_IOC + "GeneratorStatus") != 4:
-                time.sleep(POLL_TIME)
-                if self.cancel == 1:
-                    break
-            if self.cancel != 1:
+            LOG.debug('Wait for generator serial confirmation of Exposure Status')
+            ready = GENERATOR_STATUS_PV.waitForValue(GENERATOR_EXPOSURE_STATUS, self.getParam('GEN_READY_TIMEOUT'), cancel=self.isCancelled)
+            if ready:
+                self.recordTiming('PrepToReady', monotonic()-self.scanStartTime)
                 time.sleep(.002)
-            self.prepTime=time.clock()-self.scanStartTime
+            elif self.cancel != 1:
+                LOG.warning('Generator not ready after %s s, aborting', self.getParam('GEN_READY_TIMEOUT'))
+                self.cancel = 1 # stop this sequence right away, abort waits for it to finish
+                self.aid = threading.Thread(target = self.abort, args = ())
+                self.aid.start()
+            self.prepTime=monotonic()-self.scanStartTime
 
     #Check to see if camera is ready to take an image (to be run immediately before exposeNow)
     # -indifferent to scan status
     def checkIfCameraReady(self):
         if self.cancel == 0:
             #For Qi2 this is extremely simple. If TriggerReady is high, it is ready to expose
-            startTriggerWait = time.clock()
+            startTriggerWait = monotonic()
             if self.getParam('TRIGGER_READY_RBV') != 1:
-                print str(datetime.now())[:-3], 'Wait Qi2 TriggerReady', '%.4f'%(time.clock()- self.scanExposeRequestTime)
+                LOG.debug('Wait Qi2 TriggerReady %.4f', monotonic()- self.scanExposeRequestTime)
                 self.write('STATUS_RBV', self.currentFunction + ' Wait Qi2 Trigger Ready')
-                while self.getParam('TRIGGER_READY_RBV') != 1:
-                    time.sleep(POLL_TIME)
-            print str(datetime.now())[:-3], 'Qi2 TriggerReady', '%.4f'%(time.clock()- startTriggerWait)
+                self.lineState.waitFor('TRIGGER_READY_RBV', 1, cancel=self.isCancelled)
+            LOG.debug('Qi2 TriggerReady %.4f', monotonic()- startTriggerWait)
 
     #Call when immediately ready to send sync signals camera + x-ray
     #   -Sends trigger signal to  Qi2 and waits a specified GenDelay then sends CPI trigger
     #   -indifferent to scan status
     def exposeNow(self):
         if self.cancel == 0:
+            self.exposureKey = self.generatorSetting()
+            # Qi2 trigger to photospot, less the expected photospot to expose latency when triggering predictively
+            genDelay = max(0.0, self.getParam('GEN_DELAY') - self.photospotLead(0.0))
             self.write('STATUS_RBV', self.currentFunction + ' EXPOSING!')
             self.write('SEND_TRIGGER', 1) # send trigger release signal to nikon
-            self.qi2ExposeReqeustTime=time.clock()
-            self.setParam('SeqStarttoQi2', self.qi2ExposeReqeustTime-self.scanExposeRequestTime)
-            print str(datetime.now())[:-3], 'Qi2 Expose request sent', '%.4f'%(time.clock()- self.scanExposeRequestTime)
+            self.qi2ExposeReqeustTime=monotonic()
+            self.recordTiming('SeqStarttoQi2', self.qi2ExposeReqeustTime-self.scanExposeRequestTime)
+            LOG.debug('Qi2 Expose request sent %.4f', monotonic()- self.scanExposeRequestTime)
             #while True:
             #    if self.getParam("EXPOSING_RBV") == 1:
             #        break
-            time.sleep(self.getParam('GEN_DELAY'))
-            print str(datetime.now())[:-3], 'Generator Expose request sent', '%.4f'%(time.clock()- self.scanExposeRequestTime)
+            self.genDelay.spinTime = self.getParam('GEN_DELAY_SPIN')
+            achievedDelay = self.genDelay.delay(genDelay, self.qi2ExposeReqeustTime)
+            self.recordTiming('GEN_DELAY_ACHIEVED', achievedDelay)
+            self.recordTiming('GEN_DELAY_ERROR', achievedDelay - genDelay)
+            LOG.debug('Generator Expose request sent %.4f', monotonic()- self.scanExposeRequestTime)
+            self.cpiExposeRequestTime=monotonic() # taken when the write is queued, the latency includes the DAQ output queue
             self.write('PHOTOSPOT', 1)
-            self.cpiExposeRequestTime=time.clock()
             # Wait for CPI to be exposing
-            while self.getParam("EXPOSE_RBV")==0:
-                time.sleep(POLL_TIME)
-                if self.cancel == 1:
-                    break
-            if self.docmode == 1: # to save time generate doc string during exposure, usually takes less than 100ms
+            self.lineState.waitFor('EXPOSE_RBV', 1, cancel=self.isCancelled)
+            if self.docmode == 1: # to save time generate doc string during exposure, the snapshot takes microseconds
                 self.document()
                 self.filenum=self.filenum + 1 #increment local count of filenum, might be overwritten later
            # Wait for end of exposure AND Qi2 exposure, unless something sets cancel flag to 1, then return
-            print 'wait for expose to stop or qi2expose to stop'
-            while self.getParam("EXPOSE_RBV") == 1 or self.getParam("EXPOSING_RBV") == 1:
-                 time.sleep(POLL_TIME)
-                 if self.cancel == 1:
-                     break
+            LOG.debug('wait for expose to stop or qi2expose to stop')
+            self.lineState.waitUntil(lambda lines: lines['EXPOSE_RBV'] == 0 and lines['EXPOSING_RBV'] == 0, cancel=self.isCancelled)
             #W ait for CPI to finish exposing 
-            while self.getParam("EXPOSE_RBV") == 1:
-                time.sleep(POLL_TIME)
-                if self.cancel == 1:
-                    break
+            self.lineState.waitFor('EXPOSE_RBV', 0, cancel=self.isCancelled)
             #while self.getParam("EXPOSING_RBV") == 1:
             #    time.sleep(POLL_TIME)
             #    if self.cancel == 1:
             #        break
-            self.write('PHOTOSPOT',0)
-            self.write('SEND_TRIGGER',0)
+            self.writeOutputs((('PHOTOSPOT', 0), ('SEND_TRIGGER', 0)))
             time.sleep(0.025)
     
-    #experimental alternative to sleep
+    #Snapshot the scan summary and timing buffers, reset the buffers for the next scan and queue the report files
+    def queueScanReport(self):
+        scanDuration = monotonic() - self.scanStartTime
+        npts = SCAN_STATE.get('NPTS')
+        summary = [('Scan duration', scanDuration),
+                   ('Prep Time', self.prepTime),
+                   ('Number of points', npts)]
+        if npts: # None until the scan record monitor has reported
+            summary += [('Points/Duration ("FPS")', (scanDuration - self.prepTime) / npts),
+                        ('Points/sec', npts / (scanDuration - self.prepTime))]
+        summary.append(('Pipelined', self.getParam('PIPELINE')))
+        report = ScanReport('CPI-Qi2 Scan Time Report', summary, self.timingStats)
+        for buf in self.timingStats.values():
+            buf.reset()
+        basename = self.filepath + '\\' + self.filename + '_Timing_' + time.strftime("%Y%m%d-%H%M%S")
+        self.fileJobs.put(writeReport, report, basename, self.reportFormats)
+        self.edgeLog.queueFlush()
+
+    #alternative to sleep, spins for the end of the wait (see DelayScheduler)
     def busy_wait(self, dt):   
-        current_time = time.time()
-        while (time.time() < current_time+dt):
-            pass
+        return self.genDelay.delay(dt)
 
     #Call after nikon exposure has finished to set up for the next exposure, calculate image rate, update buffer
     #   -indifferent to scan status
     def exposeEnd(self):
         if self.cancel == 0:
-            #print str(datetime.now())[:-3], 'resetting qi2 exposure output'
-            with open('objs.pickle', 'w') as f:
-                pickle.dump(self.lastCpiExposure, f)
+            self.saveLastExposure()
             self.updatePVs()
 
     #sync cpi to qi2 when in live mode
-    # we have no control over qi2 frame start and end while live mode is active
-    #   (though the qi2 is very consistent in its signal output)
-    # therefore we attempt to sync cpi exposures to the signals we recieve from the qi2
-    #  in this sense the qi2 acts as the master clock 
-    #  ideally we will start a timer after every qi2 exposeout transition to zero
-    #       then exactly X seconds later we will trigger photospotin to cpi high
-    #      times must be chose such that they 
-    def liveSync2(self):
-        self.prepExpose()
-        delayPhotospotToExposeOut=.015
-        delayQi2ExposeOfftoOn=.043
-        self.liveRecoveryPeriod=delayQi2ExposeOfftoOn - delayPhotospotToExposeOut
-        while self.getParam('HighSpeedCpiTest') == 1 and self.cancel == 0:
-            if self.getParam('EXPOSING_RBV') == 0:
-                if self.firstImageFlag == 1:
-                    caput(DET_IOC + 'cam1:Acquire', 1)
-                    offset = 0 
-                    ##
-                    #wait for one frame to finish, and on transition to 0 continue
-                    while(self.getParam('EXPOSING_RBV')==0) and self.cancel == 0:
-                        time.sleep(POLL_TIME)
-                    while(self.getParam('EXPOSING_RBV')==1) and self.cancel == 0:
-                        time.sleep(POLL_TIME)
-                else: #not the first image, but qi2 exposure already over so we need to account for lateness
-                    #offset is time since qi2 exposure ended 
-                    print 'THREAD LATE: qi2 already finished exposing attempting to compensate'
-                    offset = time.clock() - self.qi2ExposeEndTime
-            else: # qi2 is exposing and we need to wait for it to transition to 0 before sleeping
-                offset = 0 
-                print '!!!wait for qi2 to go to zero!!!!'
-                while(self.getParam('EXPOSING_RBV')==1) and self.cancel == 0:
-                    time.sleep(POLL_TIME)
-            #Ideally starting from here code executes right on transition to zero 
-            # qi2 exposing just went from 1 to 0 indicating a frame just ended 
-            # sigexposureoutput set to "OUTPUT" results in 42.5 - 44.5 milliseconds gap between end and start signals 
-            # for 100 millisecond exposures
-            #print "sleeping for ", self.liveRecoveryPeriod-offset , " seconds"
-            time.sleep(self.liveRecoveryPeriod-offset)
-            #request CPI exposure 
-            self.write('PHOTOSPOT', 1)
-            #wait for start of cpi exposure
-            #print "wait for cpi exposeout start"
-            while self.getParam('EXPOSE_RBV') == 0 and self.cancel == 0:
-                time.sleep(POLL_TIME)
-            #print "wait for cpi exposeout end"
-            #wait for end of cpi exposure
-            while self.getParam('EXPOSE_RBV') == 1 and self.cancel == 0:
-                time.sleep(POLL_TIME)
-            #print "SINGLE SEQUENCE FINISH"
-            #self.write('PHOTOSPOT', 0)
-        caput(DET_IOC + 'cam1:Acquire', 0)
-        #sequence is over reset flag to 1
-        self.firstImageFlag = 1
-    
+    # we have no control over qi2 frame start and end while live mode is active, the qi2 is the master clock
+    #   framePll follows its frame starts (EXPOSING_RBV rising) and predicts the next ones, each photospot is
+    #   scheduled ahead of time for the first predicted frame it can still make: LIVE_PHASE after the frame
+    #   start, minus the photospot to expose latency LIVE_LEAD. Fires only while the PLL is locked.
+    #   LIVE_SYNC 0 or abort ends it
     def liveSync(self):
-        oldheartbeattime=0
-        self.prepExpose()
-        caput(DET_IOC + 'cam1:Acquire', 1)
-        while True and self.cancel == 0:
-            while self.qi2EndFlag != True:
-                time.sleep(POLL_TIME)
-            self.qi2EndFlag = False
-            heartbeattime= time.clock()
-            time.sleep(0.035)
-            self.write('PHOTOSPOT', 1)
-            print str(datetime.now())[:-3],'PHOTSPOT NOW', heartbeattime - oldheartbeattime
-            oldheartbeattime=heartbeattime
-        self.write('PHOTOSPOT', 0)
-        caput(DET_IOC + 'cam1:Acquire', 0)
-        caput(DET_IOC + 'cam1:Acquire', 0)
-
-    def liveSync3(self):
-        self.firstImageFlag=1
-        #self.prepExpose()
-        delayPhotospotToExposeOut=0#.015
-        delayQi2ExposeOfftoOn=0#.043
-        self.liveRecoveryPeriod=delayQi2ExposeOfftoOn - delayPhotospotToExposeOut
-        oldheartbeattime=0
-        while self.getParam('HighSpeedCpiTest') == 1 and self.cancel == 0:
-            if self.getParam('EXPOSING_RBV') == 0:
-                if self.firstImageFlag == 1:
-                    offset = 0 
-                    caput(DET_IOC + 'cam1:Acquire', 1)
-                    ##
-                    #wait for one frame to finish, and on transition to 0 continue
-                    print 'wait for first exposure to start'
-                    while(self.getParam('EXPOSING_RBV')==0) and self.cancel == 0:
-                        time.sleep(POLL_TIME)
-                    print 'wait for first exposure to finish'
-                    while(self.getParam('EXPOSING_RBV')==1) and self.cancel == 0:
-                        time.sleep(POLL_TIME)
-                    self.firstImageFlag=0 #no longer the first image
-                else: #not the first image, but qi2 exposure already over so we need to account for lateness
-                    #offset is time since qi2 exposure ended 
-                    print 'THREAD LATE: qi2 already finished exposing attempting to compensate'
-                    offset = time.clock() - self.qi2ExposeEndTime
-            else: # qi2 is exposing and we need to wait for it to transition to 0 before sleeping
-                offset = 0 
-                print '!!!wait for qi2 to go to zero!!!!'
-                while(self.getParam('EXPOSING_RBV')==1) and self.cancel == 0:
-                    time.sleep(POLL_TIME)
-            #Ideally starting from here code executes right on transition to zero 
-            # qi2 exposing just went from 1 to 0 indicating a frame just ended 
-            # sigexposureoutput set to "OUTPUT" results in 42.5 - 44.5 milliseconds gap between end and start signals 
-            # for 100 millisecond exposures
-            #print "sleeping for ", self.liveRecoveryPeriod-offset , " seconds"
-            
-            time.sleep(self.liveRecoveryPeriod-offset)
-            #request CPI exposure 
-            heartbeattime= time.clock()
-            print str(datetime.now())[:-3],'heartbeat', heartbeattime - oldheartbeattime
-            oldheartbeattime=heartbeattime
-
-            #self.write('PHOTOSPOT', 1)
-            #wait for start of cpi exposure
-            #print "wait for cpi exposeout start"
-            #while self.getParam('EXPOSE_RBV') == 0 and self.cancel == 0:
-            #    time.sleep(POLL_TIME)
-            #print "wait for cpi exposeout end"
-            #wait for end of cpi exposure
-            #while self.getParam('EXPOSE_RBV') == 1 and self.cancel == 0:
-            #    time.sleep(POLL_TIME)
-            #print "SINGLE SEQUENCE FINISH"
-            #self.write('PHOTOSPOT', 0)
-        caput(DET_IOC + 'cam1:Acquire', 0)
-        caput(DET_IOC + 'cam1:Acquire', 0)
-        #sequence is over reset flag to 1
-        self.firstImageFlag = 1
+        try:
+            self.setSeqInProgress(1)
+            self.currentFunction = 'Live Sync'
+            self.framePll.reset()
+            self.framePll.tolerance = self.getParam('LIVE_LOCK_TOL')
+            shots = missed = 0
+            lastFrame = None
+            self.prepExpose()
+            self.exposureKey = self.generatorSetting()
+            ACQUIRE_PV.put(1)
+            self.write('STATUS_RBV', 'Live Sync: locking to Qi2 frames')
+            while self.getParam('LIVE_SYNC') == 1 and self.cancel == 0:
+                if not self.framePll.locked:
+                    # every frame start re-checks the lock
+                    self.lineState.waitUntil(lambda lines: self.framePll.locked or self.getParam('LIVE_SYNC') == 0,
+                                             timeout=1.0, cancel=self.isCancelled)
+                    lastFrame = None
+                    self.publishLiveSync(shots, missed)
+                    continue
+                lead, phase = self.photospotLead(self.getParam('LIVE_LEAD')), self.getParam('LIVE_PHASE')
+                frame = self.framePll.frameAfter(monotonic() + lead - phase)
+                if frame is None:
+                    # lost the prediction since the lock check, the next frame start brings it back
+                    self.lineState.waitUntil(lambda lines: self.framePll.prediction is not None or self.getParam('LIVE_SYNC') == 0,
+                                             timeout=1.0, cancel=self.isCancelled)
+                    continue
+                index, start, period = frame
+                if lastFrame is not None and index > lastFrame + 1:
+                    missed += index - lastFrame - 1
+                lastFrame = index
+                self.genDelay.waitUntil(start + phase - lead)
+                self.cpiExposeRequestTime = monotonic()
+                self.write('PHOTOSPOT', 1)
+                shots += 1
+                # processInputs drops PHOTOSPOT at the end of the exposure
+                # the period this frame was predicted with, edges meanwhile may reset the PLL
+                if self.lineState.waitFor('EXPOSE_RBV', 1, timeout=max(period, 2 * lead), cancel=self.isCancelled):
+                    self.setParam('LIVE_XRAY_PHASE', self.cpiExposeStartTime - start)
+                    self.lineState.waitFor('EXPOSE_RBV', 0, timeout=1.0, cancel=self.isCancelled)
+                elif self.cancel == 0:
+                    LOG.warning('Live Sync: no CPI exposure in frame %d', index)
+                    self.write('PHOTOSPOT', 0)
+                    missed += 1
+                self.publishLiveSync(shots, missed)
+            self.write('PHOTOSPOT', 0)
+            ACQUIRE_PV.put(0)
+            self.publishLiveSync(shots, missed)
+            if self.cancel == 0:
+                self.writeOutputs(EXPOSURE_OFF)
+                self.write('STATUS_RBV', 'Idle')
+            LOG.info('Live Sync over: %d shots, %d frames missed', shots, missed)
+        finally:
+            self.setSeqInProgress(0)
+            self.liveSyncOn = False # set by write('LIVE_SYNC', 1)
+
+    def publishLiveSync(self, shots, missed):
+        self.setParam('LIVE_LOCKED', int(self.framePll.locked))
+        self.setParam('LIVE_PERIOD', self.framePll.period)
+        self.setParam('LIVE_PHASE_ERROR', self.framePll.phaseError)
+        self.setParam('LIVE_SHOTS', shots)
+        self.setParam('LIVE_MISSED', missed)
+        self.setParam('LIVE_MISSED_EDGES', self.framePll.missedEdges)
+        self.updatePVs()
 
     #Testing how quickly we can toggle Photospot on and off
     # seems to be 5-10millisecond delay from triggering photospot until cpi is exposing
-    def highSpeedCpi(self):
-        self.prepExpose()
-        time.sleep(.01)
-        cpiOldEnd = 0
-        while self.cancel==0:
-            sendPSin = time.clock()
-            self.write('PHOTOSPOT', 1)
-            #wait for start of cpi exposure
-            print 'wait for start of exposure'
-            while self.getParam('EXPOSE_RBV')==0:
-                time.sleep(POLL_TIME)
-                if self.cancel == 1:
-                    break
-            # cpi exposure started
-            cpiStart = time.clock()
-            print 'wait for end of exposure'
-            # wait for end of cpi exposure
-            while self.getParam('EXPOSE_RBV') == 1:
-                time.sleep(POLL_TIME)
-                if self.cancel == 1:
-                    break
-            # cpi exposure ended
-            cpiEnd = time.clock()
-            print '!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!! cpi expose on for', cpiEnd - cpiStart
-            print '!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!! photospot in lag', cpiStart - sendPSin
-            print '!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!! duty cycle ', cpiEnd - cpiOldEnd
-            cpiOldEnd= cpiEnd
-            # cpi needs some time to prepare for next shot
-            time.sleep(0.01)
-            print 'endloop'
-        self.exposeEnd()
-
     """
     Call when user hits abort button (through write function) or hits abort on scan (through callback function)
      -set self.cancel = 1 - this lets any sequences in progress know to cancel 
@@ -899,17 +1202,15 @@ class myDriver(Driver):
     """
     def abort(self):
         self.write('STATUS_RBV', self.currentFunction + ' ABORTING!')
+        self.aborts += 1
         self.cancel=1 # flag to tell exposures to cancel
-        self.write('PHOTOSPOT', 0)
-        self.write('EXPOSE', 0)
-        self.write('FLUORO',0)
-        self.write('RAD_PREP',0)
-        self.write('SEND_TRIGGER', 0)
-        if caget(SCANPROGRESSIOC +'running') == 1:
+        self.lineState.wake() # sequences blocked waiting on a line re-check the cancel flag
+        GENERATOR_STATUS_PV.wake()
+        self.writeOutputs(ALL_OUTPUTS_OFF)
+        if SCAN_STATE.get('running') == 1:
             SCAN_CANCEL_IOC.put(1)
         # wait for any sequence in progress to finish
-        while self.seqInProgress == 1:
-            time.sleep(POLL_TIME)
+        self.lineState.waitFor('seqInProgress', 0)
         self.cancel=0
         self.write('STATUS_RBV', self.currentFunction + ' Abort complete')
 
@@ -917,7 +1218,7 @@ class myDriver(Driver):
     Need to monitor scan abort PV so we can properly disable exposure/RadPrep
     """
     def ScanMonitor(self, **kw):
-        print str(datetime.now())[:-3], 'Scan Abort Callback'
+        LOG.info('Scan Abort Callback')
         #This if statement is true if the scan was canceled, and Radprep is true
         if self.getParam('RAD_PREP')== 1 and self.cancel == 0 : 
             self.aid = threading.Thread(target = self.abort, args = ())
@@ -954,56 +1255,97 @@ class myDriver(Driver):
         Sequence to turn cpi generator on
         """
         self.write('STATUS_RBV', 'Powering Generator On')
-        self.setDigiOut(self.powerOnTask, HIGH)
+        self.daqOut.put(self.setDigiOut, self.powerOnTask, HIGH)
         time.sleep(.6) # simulating push button
-        self.setDigiOut(self.powerOnTask, LOW)
+        self.daqOut.put(self.setDigiOut, self.powerOnTask, LOW)
         time.sleep(4)
         self.write('STATUS_RBV', 'Idle')
-        caput(XRAY_IOC + 'GetKVP.PROC', 1) # try to update values since they will be out of sync
+        CPI_GETKVP_PV.put(1) # try to update values since they will be out of sync
         
     def Off(self):
         """
         Sequence to turn cpi generator off
         """
         self.write('STATUS_RBV', 'Powering Generator Off')
-        self.setDigiOut(self.powerOffTask, HIGH)
+        self.daqOut.put(self.setDigiOut, self.powerOffTask, HIGH)
         time.sleep(.6) #simulating push button
-        self.setDigiOut(self.powerOffTask, LOW)
+        self.daqOut.put(self.setDigiOut, self.powerOffTask, LOW)
         self.write('STATUS_RBV', 'Idle')
 
-    def RadPrepOn(self):
-        time.sleep(.1)
-        self.setDigiOut(self.radPrepInTask, HIGH)
-
-    def RadPrepOff(self):
-        self.setDigiOut(self.radPrepInTask, LOW)
-        time.sleep(.1)
-    
     def setDigiOut(self, DAQtaskName, value ):
         #print 'setdigiout', value, str(DAQtaskName)
-        #startDO = time.clock()
+        #startDO = monotonic()
+        if self.portTask is not None:
+            self.writePortLines([(self.portLine(DAQtaskName), value)])
+            return
         if type(value) != numpy.ndarray:
             if value == 0:
                 value = LOW
             else:
                 value = HIGH
         self.processDAQstatus(DAQmxWriteDigitalLines(DAQtaskName,1,1,10.0,DAQmx_Val_GroupByChannel, value ,self.written, None))
-        #print 'write took', time.clock() - startDO
+        #print 'write took', monotonic() - startDO
+
+    #Write several output records in order, changes is a sequence of (record (outputTasks key), value)
+    #   with the port task this is a single DAQmxWriteDigitalLines call
+    def setDigiOutLines(self, changes):
+        if self.portTask is None:
+            for reason, value in changes:
+                self.setDigiOut(self.outputTasks[reason], value)
+        else:
+            self.writePortLines([(self.outputLines[reason], value) for reason, value in changes])
+
+    #Write lines of the port task, changes is a sequence of (line name, value)
+    def writePortLines(self, changes):
+        values = self.portShadow.apply(changes)
+        self.processDAQstatus(DAQmxWriteDigitalLines(self.portTask,1,1,10.0,DAQmx_Val_GroupByChannel, values ,self.written, None))
+
+    #line name of a per line task handle registered with the port task (compared by identity)
+    def portLine(self, DAQtaskName):
+        for task, line in self.portLines:
+            if task is DAQtaskName:
+                return line
+        raise KeyError('task not in the port task')
 
     def processDAQstatus(self, errorcode):
         if errorcode != 0:
-            print str(datetime.now())[:-3], "NI-DAQ error! Code:", errorcode
+            LOG.error('NI-DAQ error! Code: %s', errorcode)
 
 if __name__ == '__main__':
     server = SimpleServer()
+    parser = argparse.ArgumentParser(description='CPI/Qi2 sync pcas IOC')
+    parser.add_argument('--input', choices=('poll', 'change'), default=INPUT_BACKEND,
+                        help='input edge detection: poll the lines, or DAQmx change detection callbacks')
+    parser.add_argument('--sim', action='store_true',
+                        help='run without hardware, against the simulated DAQ and generator/camera models in syncSim')
+    parser.add_argument('--report', nargs='+', choices=sorted(REPORT_WRITERS), default=list(REPORT_FORMATS),
+                        help='end of scan timing report file formats')
+    parser.add_argument('--log-level', choices=LEVEL_NAMES, default='DEBUG',
+                        help='DEBUG logs every edge and sequence step, use INFO or above in production')
+    args = parser.parse_args()
+    pvdb['LOG_LEVEL']['value'] = LEVEL_NAMES.index(args.log_level)
+    LOG.setLevel(args.log_level)
     server.createPV(prefix, pvdb)
-    driver = myDriver()
-    # process CA transactions
-    while True:
-        try:
-            server.process(0.0001)
-        except KeyboardInterrupt:
-            try:
-                sys.exit(0)
-            except SystemExit:
-                os._exit(0)
+    driver = myDriver(inputBackend=args.input, reportFormats=args.report)
+    # CA transactions are served by pcaspy's server thread, blocking in select() between requests.
+    #   The main thread only waits for Ctrl-C / SIGTERM and shuts down
+    serverThread = ServerThread(server)
+    serverThread.start()
+
+    def terminate(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, terminate)
+    try:
+        while serverThread.is_alive():
+            time.sleep(1.0)
+    except KeyboardInterrupt:
+        pass
+    serverThread.stop()
+    LAST_EXPOSURE_STORE.flush() # os._exit skips atexit
+    driver.saveLatencyModel()
+    LATENCY_STORE.flush()
+    # the last edges go through the file writer like every other flush, and it finishes its queue first
+    driver.edgeLog.queueFlush()
+    driver.fileJobs.join()
+    LOG.flush()
+    os._exit(0) # the DAQ and pcaspy threads would keep the process alive
@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+"""
+Exposure sequence latency benchmark for indico100Sync.py.
+Runs the real sequences (NikonSingleExposeSeq, NikonScanExposeSeq with and without PIPELINE, GenExposeOnly, abort)
+against the simulated DAQ, CPI/Qi2 models and PVs in syncSim, so no hardware or IOCs are needed.
+Latencies are taken from the simulated lines themselves (what the generator and camera would see)
+and from the driver's own timing records, and saved as JSON with the git revision so runs can be compared:
+
+    python syncBench.py --output bench.json
+    python syncBench.py --compare bench_old.json bench.json
+"""
+import sys
+if '--sim' not in sys.argv:
+    sys.argv.append('--sim') # the driver picks its DAQ/EPICS backend at import
+import argparse, json, os, platform, subprocess, tempfile, threading, time
+from datetime import datetime
+import numpy as np
+from syncClock import monotonic
+
+# percentiles reported for every metric
+PERCENTILES = (50, 90, 99)
+
+
+class LineRecorder(object):
+    """
+    Timestamps (monotonic) of every rising edge on the watched simulated lines
+    """
+    def __init__(self, device, lines):
+        self.rising = dict((line, []) for line in lines)
+        self.lock = threading.Lock()
+        device.watch(lines, self.changed)
+
+    def changed(self, line, value):
+        if value:
+            with self.lock:
+                self.rising[line].append(monotonic())
+
+    def mark(self):
+        """
+        Current number of edges per line, to select the edges of one run
+        """
+        with self.lock:
+            return dict((line, len(edges)) for line, edges in self.rising.items())
+
+    def latencies(self, starts, endLine, since):
+        """
+        For each start time, delay until the first rising edge of endLine after it (edges after since=mark())
+        """
+        with self.lock:
+            edges = self.rising[endLine][since[endLine]:]
+        result = []
+        for start in starts:
+            later = [edge for edge in edges if edge >= start]
+            if later:
+                result.append(later[0] - start)
+        return result
+
+    def edgeLatencies(self, startLine, endLine, since):
+        """
+        Delay from each rising edge of startLine to the next rising edge of endLine
+        """
+        with self.lock:
+            starts = self.rising[startLine][since[startLine]:]
+        return self.latencies(starts, endLine, since)
+
+
+def stats(values):
+    values = np.asarray(values, dtype=float)
+    if len(values) == 0:
+        return {'n': 0}
+    result = {'n': len(values), 'mean': float(values.mean()), 'max': float(values.max())}
+    for p in PERCENTILES:
+        result['p%d' % p] = float(np.percentile(values, p))
+    return result
+
+
+JOIN_TIMEOUT = 30 # s, a sequence thread still alive after this is reported as a failure
+
+
+def gitRevision():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except Exception:
+        return 'unknown'
+
+
+def benchDriver(sync):
+    """
+    The driver class with every timing record also kept in timingLog (the driver's own buffers reset at the end of a scan)
+    """
+    class BenchDriver(sync.myDriver):
+        def __init__(self, *args, **kw):
+            self.timingLog = {}
+            super(BenchDriver, self).__init__(*args, **kw)
+
+        def recordTiming(self, reason, value):
+            super(BenchDriver, self).recordTiming(reason, value)
+            self.timingLog.setdefault(reason, []).append(value)
+    return BenchDriver
+
+
+class Bench(object):
+    def __init__(self, sync, driver, args):
+        self.sync = sync
+        self.driver = driver
+        self.args = args
+        self.lines = LineRecorder(sync.DEVICE, [sync.QI2_EXPOSE, sync.QI2_EXPOSEOUT, sync.CPI_PHOTOSPOT_IN, sync.CPI_EXPOSE_OUT])
+        self.scanWait = threading.Event()
+        self.failures = []
+        self.current = None
+        sync.PV(sync.SCAN_IOC + 'scan1.WAIT', callback=self.scanWaitPut)
+
+    def scanWaitPut(self, value=None, **kw):
+        if value == 0:
+            self.scanWait.set()
+
+    def timingMark(self):
+        return dict((reason, len(values)) for reason, values in self.driver.timingLog.items())
+
+    def timingValues(self, reason, since):
+        return self.driver.timingLog.get(reason, [])[since.get(reason, 0):]
+
+    def fail(self, message):
+        self.failures.append('%s: %s' % (self.current, message))
+
+    def idle(self):
+        """
+        Wait for the generator to drop out of rad ready and the camera to be ready, between runs
+        """
+        if not self.driver.lineState.waitUntil(lambda lines: lines['RAD_READY_RBV'] == 0 and lines['TRIGGER_READY_RBV'] == 1
+                                               and lines['seqInProgress'] == 0, timeout=10):
+            self.fail('not idle after 10 s (%s)' % self.driver.lineState.lines)
+
+    def join(self, thread, what):
+        """
+        Wait for a sequence thread, False (and a failure) if it is still running after JOIN_TIMEOUT
+        """
+        thread.join(JOIN_TIMEOUT)
+        if thread.is_alive():
+            self.fail('%s still running after %d s' % (what, JOIN_TIMEOUT))
+            return False
+        return True
+
+    def lineMetrics(self, requests, since):
+        sync = self.sync
+        return {'request_to_trigger'    : self.lines.latencies(requests, sync.QI2_EXPOSE, since),
+                'trigger_to_qi2_expose' : self.lines.edgeLatencies(sync.QI2_EXPOSE, sync.QI2_EXPOSEOUT, since),
+                'photospot_to_cpi_expose': self.lines.edgeLatencies(sync.CPI_PHOTOSPOT_IN, sync.CPI_EXPOSE_OUT, since),
+                'trigger_to_cpi_expose' : self.lines.edgeLatencies(sync.QI2_EXPOSE, sync.CPI_EXPOSE_OUT, since)}
+
+    def single(self):
+        since = self.lines.mark()
+        requests, durations = [], []
+        for shot in range(self.args.shots):
+            self.idle()
+            start = monotonic()
+            requests.append(start)
+            self.driver.write('NikonSingleExposeSeq', 1)
+            if not self.join(self.driver.fid, 'single shot %d' % shot):
+                break
+            durations.append(monotonic() - start)
+        metrics = self.lineMetrics(requests, since)
+        metrics['shot_duration'] = durations
+        return metrics, {}
+
+    def scan(self, pipeline):
+        sync, driver = self.sync, self.driver
+        self.idle()
+        driver.setParam('PIPELINE', 1 if pipeline else 0)
+        points = self.args.points
+        for field, value in (('scan1.NPTS', points), ('scanProgress:Ntotal', points), ('scanProgress:running', 1),
+                             ('scan1.P1PV', '')):
+            sync.caput(sync.SCAN_IOC + field, value)
+        since = self.lines.mark()
+        timing = self.timingMark()
+        requests, pointTimes = [], []
+        scanStart = monotonic()
+        for point in range(points):
+            sync.caput(sync.SCAN_IOC + 'scan1.CPT', point)
+            sync.caput(sync.SCAN_IOC + 'scanProgress:Nfinished', point)
+            self.scanWait.clear()
+            start = monotonic()
+            requests.append(start)
+            driver.write('NikonScanExposeSeq', 1)
+            if not self.scanWait.wait(30):
+                self.fail('scan point %d timed out' % point)
+                break
+            pointTimes.append(monotonic() - start)
+            time.sleep(self.args.move) # motor move to the next point
+        scanTime = monotonic() - scanStart
+        sync.caput(sync.SCAN_IOC + 'scanProgress:running', 0)
+        if not driver.lineState.waitFor('seqInProgress', 0, timeout=10):
+            self.fail('sequence still in progress 10 s after the last point')
+        driver.setParam('PIPELINE', 0)
+        metrics = self.lineMetrics(requests, since)
+        metrics['point_handshake'] = pointTimes
+        metrics['shot_duration'] = self.timingValues('ShotDuration', timing)
+        return metrics, {'points_per_sec': len(pointTimes) / scanTime}
+
+    def genExpose(self):
+        self.idle()
+        since = self.lines.mark()
+        start = monotonic()
+        self.driver.GenExposeOnly(80, 25, 100, self.args.shots, self.args.duty)
+        total = monotonic() - start
+        metrics = {'photospot_to_cpi_expose': self.lines.edgeLatencies(self.sync.CPI_PHOTOSPOT_IN, self.sync.CPI_EXPOSE_OUT, since)}
+        return metrics, {'total_time': total}
+
+    def abort(self):
+        """
+        Abort a single shot while it waits for rad ready, time from the ABORT write to every line low and the sequence over
+        """
+        driver = self.driver
+        latencies = []
+        for shot in range(self.args.aborts):
+            self.idle()
+            driver.write('NikonSingleExposeSeq', 1)
+            seq = driver.fid
+            driver.lineState.waitFor('RAD_PREP_RBV', 1, timeout=10)
+            start = monotonic()
+            driver.write('ABORT', 1)
+            if not (self.join(driver.fid, 'abort %d' % shot) and self.join(seq, 'aborted shot %d' % shot)):
+                break
+            latencies.append(monotonic() - start)
+        return {'abort_to_idle': latencies}, {}
+
+    def run(self):
+        runs = [('single', self.single),
+                ('scan', lambda: self.scan(False)),
+                ('scan_pipelined', lambda: self.scan(True)),
+                ('gen_expose', self.genExpose),
+                ('abort', self.abort)]
+        results = {}
+        for name, func in runs:
+            if self.args.runs and name not in self.args.runs:
+                continue
+            self.current = name
+            metrics, extra = func()
+            results[name] = dict(extra, metrics=dict((metric, stats(values)) for metric, values in metrics.items()))
+        return results
+
+
+def printResults(results, reference=None):
+    header = '%-16s %-26s %4s' % ('run', 'metric', 'n') + ''.join('%10s' % key for key in ['mean'] + ['p%d' % p for p in PERCENTILES] + ['max'])
+    print header + ('%10s' % 'ref p50' if reference else '')
+    for name in sorted(results):
+        for metric in sorted(results[name]['metrics']):
+            s = results[name]['metrics'][metric]
+            line = '%-16s %-26s %4d' % (name, metric, s['n'])
+            if s['n']:
+                line += ''.join('%10.4f' % s[key] for key in ['mean'] + ['p%d' % p for p in PERCENTILES] + ['max'])
+                try:
+                    line += '%10.4f' % reference[name]['metrics'][metric]['p50']
+                except (TypeError, KeyError):
+                    pass
+            print line
+        for key in sorted(results[name]):
+            if key != 'metrics':
+                print '%-16s %-26s %10.4f' % (name, key, results[name][key])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='indico100Sync exposure sequence latency benchmark (simulated hardware)')
+    parser.add_argument('--sim', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--shots', type=int, default=20, help='single shots, and exposures in the GenExposeOnly run')
+    parser.add_argument('--points', type=int, default=20, help='points per scan')
+    parser.add_argument('--aborts', type=int, default=5, help='aborted shots')
+    parser.add_argument('--move', type=float, default=0.05, help='simulated motor move time between scan points (s)')
+    parser.add_argument('--duty', type=float, default=0.05, help='GenExposeOnly duty cycle sleep (s)')
+    parser.add_argument('--prep', type=float, default=0.2, help='simulated RAD_PREP to RAD_READY time (s)')
+    parser.add_argument('--seed', type=int, default=0, help='simulation jitter seed')
+    parser.add_argument('--runs', nargs='+', choices=('single', 'scan', 'scan_pipelined', 'gen_expose', 'abort'),
+                        help='only these runs (default all)')
+    parser.add_argument('--output', help='save results as JSON')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help='print two saved results side by side and exit')
+    parser.add_argument('--verbose', action='store_true', help='keep the driver output')
+    parser.add_argument('--port-output', action='store_true', help='drive the output lines through one port task (PORT_OUTPUT)')
+    args = parser.parse_args()
+
+    if args.compare:
+        with open(args.compare[0]) as f:
+            old = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        print 'old', old['revision'], old['date'], ' new', new['revision'], new['date']
+        printResults(new['results'], old['results'])
+        return
+
+    output = os.path.abspath(args.output) if args.output else None
+    stdout = sys.stdout
+    if not args.verbose:
+        sys.stdout = open(os.devnull, 'w')
+    import indico100Sync as sync
+    from pcaspy import SimpleServer
+    # the driver writes objs.pickle to the working directory and doc strings/reports to the file path, keep them out of the tree
+    workdir = tempfile.mkdtemp(prefix='syncBench')
+    revision = gitRevision() # before the chdir, __file__ may be relative
+    os.chdir(workdir)
+    sync.DEVICE.seed(args.seed)
+    sync.PORT_OUTPUT = args.port_output
+    sync.SIM_CPI.timing['prepTime'] = args.prep
+    sync.caput(sync.DET_IOC + 'TIFF1:FilePath', workdir)
+    sync.caput(sync.DET_IOC + 'TIFF1:FileName', 'bench')
+    sync.caput(sync.DET_IOC + 'TIFF1:FileNumber', 0)
+    server = SimpleServer()
+    server.createPV(sync.prefix, sync.pvdb)
+    driver = benchDriver(sync)()
+    bench = Bench(sync, driver, args)
+    results = bench.run()
+    sys.stdout = stdout
+
+    doc = {'revision': revision,
+           'date'    : str(datetime.now()),
+           'platform': platform.platform(),
+           'config'  : {'args': vars(args), 'cpi': sync.SIM_CPI.timing, 'qi2': sync.SIM_QI2.timing,
+                        'input_backend': sync.INPUT_BACKEND, 'port_output': sync.PORT_OUTPUT, 'gen_delay': driver.getParam('GEN_DELAY')},
+           'results' : results,
+           'failures': bench.failures}
+    printResults(results)
+    for failure in bench.failures:
+        print 'FAILED', failure
+    if output:
+        with open(output, 'w') as f:
+            json.dump(doc, f, indent=1, sort_keys=True)
+    os._exit(1 if bench.failures else 0) # driver threads are not daemons
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+Clock shared by the cpiSync pcas drivers (indico100Sync.py, cmp200Sync.py) and their helpers.
+monotonic() is the one source for every duration and timestamp: time.clock() is QueryPerformanceCounter
+on Windows but process CPU time on Linux, so it can't be used for timing outside Windows.
+wall() converts a monotonic() timestamp to time.time() seconds, stamp() is the log line timestamp
+(same text as str(datetime.now())[:-3]) with the date and seconds formatted only once a second.
+The two clocks drift apart (and time.time() steps with NTP), the drivers call calibrate() from their timer wheel.
+"""
+import os, sys, time
+from datetime import datetime
+
+if hasattr(time, 'perf_counter'):                           # python 3
+    monotonic = time.perf_counter
+elif sys.platform == 'win32':                               # QueryPerformanceCounter, sub microsecond
+    monotonic = time.clock
+else:                                                       # clock_gettime(CLOCK_MONOTONIC)
+    import ctypes, ctypes.util
+    CLOCK_MONOTONIC = 1
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    _clock_gettime = ctypes.CDLL(ctypes.util.find_library('rt') or ctypes.util.find_library('c'), use_errno=True).clock_gettime
+    _clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+
+    def monotonic():
+        ts = timespec()
+        if _clock_gettime(CLOCK_MONOTONIC, ctypes.byref(ts)) != 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+
+# time.time() - monotonic(), taken at import and refreshed by calibrate()
+WALL_OFFSET = time.time() - monotonic()
+
+
+def calibrate(samples=5):
+    """
+    Recompute WALL_OFFSET from the time.time() read that sits between the closest pair of monotonic() reads
+    """
+    global WALL_OFFSET
+    best = None
+    for i in range(samples):
+        before = monotonic()
+        now = time.time()
+        after = monotonic()
+        if best is None or after - before < best[0]:
+            best = (after - before, now - (before + after) / 2)
+    WALL_OFFSET = best[1]
+
+
+def wall(t):
+    """
+    time.time() seconds of a monotonic() timestamp
+    """
+    return t + WALL_OFFSET
+
+
+_second = (None, '')                                        # (whole second, its formatted date and time)
+
+
+def stamp(t=None):
+    """
+    'YYYY-MM-DD HH:MM:SS.mmm' of a monotonic() timestamp (default now)
+    """
+    global _second
+    w = time.time() if t is None else wall(t)
+    second = int(w)
+    cached = _second
+    if cached[0] != second:
+        cached = (second, datetime.fromtimestamp(second).strftime('%Y-%m-%d %H:%M:%S'))
+        _second = cached
+    return '%s.%03d' % (cached[1], int((w - second) * 1000))
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+NI-DAQ helpers shared by the cpiSync pcas drivers (indico100Sync.py, cmp200Sync.py).
+"""
+import threading
+import numpy
+from syncClock import monotonic
+from syncJobs import JobQueue
+from syncTiming import LogHistogram
+
+# Longest single Condition.wait of a timed LineState wait (seconds). Python 2 Condition.wait(timeout) polls
+#   with a sleep that doubles up to 50 ms, re-entering it this often keeps a notify from going unseen that long
+WAIT_SLICE = 0.005
+
+
+class OutputWorker(JobQueue):
+    """
+    One long-lived thread per DAQ that performs digital output writes in the order they were queued.
+    Each command is timestamped when it is queued and when the write returns, the difference
+    (queue to wire latency) goes into self.histogram.
+    """
+    def __init__(self, name='daqOutput'):
+        self.histogram = LogHistogram()
+        self.lastLatency = 0.0
+        super(OutputWorker, self).__init__(name)
+
+    def jobDone(self, queueTime):
+        self.lastLatency = monotonic() - queueTime
+        self.histogram.add(self.lastLatency)
+
+
+class PortShadow(object):
+    """
+    Shadow copy of the lines in a port level digital output task.
+    A change to one or several lines produces the full array for a single DAQmxWriteDigitalLines call.
+    """
+    def __init__(self, lines):
+        self.lines = list(lines)
+        self.index = dict((line, i) for i, line in enumerate(self.lines))
+        self.values = numpy.zeros((len(self.lines),), dtype=numpy.uint8)
+        self.lock = threading.Lock()
+
+    def apply(self, changes):
+        """
+        changes is a sequence of (line, value (0/1 or LOW/HIGH array)), returns a copy of the new port values
+        """
+        with self.lock:
+            for line, value in changes:
+                self.values[self.index[line]] = 1 if numpy.any(value) else 0
+            return self.values.copy()
+
+
+class LineState(object):
+    """
+    Latest value of the DAQ lines (and any other state fed to it), with a condition variable that is
+    notified on every change. Sequences block in waitFor/waitUntil and wake as soon as the input
+    backend hands over the edge, instead of polling getParam with time.sleep.
+    """
+    def __init__(self, names):
+        self.condition = threading.Condition()
+        self.values = dict((name, 0) for name in names)
+
+    def update(self, changes):
+        with self.condition:
+            self.values.update(changes)
+            self.condition.notify_all()
+
+    def wake(self):
+        """
+        Wake every waiter so it re-checks its cancel test (call after setting the cancel flag)
+        """
+        with self.condition:
+            self.condition.notify_all()
+
+    def waitUntil(self, test, timeout=None, cancel=None):
+        """
+        Block until test(values) is true. Returns True when it is, False on timeout or once cancel() is true.
+        Each wake up re-checks test and cancel and waits again for what is left of the timeout (in WAIT_SLICE steps).
+        """
+        deadline = None if timeout is None else monotonic() + timeout
+        with self.condition:
+            while not test(self.values):
+                if cancel is not None and cancel():
+                    return False
+                if deadline is None:
+                    self.condition.wait()
+                else:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        return False
+                    self.condition.wait(min(remaining, WAIT_SLICE))
+            return True
+
+    def pause(self, timeout, cancel=None):
+        """
+        Sleep for timeout seconds, returns False early once cancel() is true (see wake)
+        """
+        return not self.waitUntil(lambda values: cancel is not None and cancel(), timeout)
+
+    def waitFor(self, name, value, timeout=None, cancel=None):
+        """
+        Block until line name equals value, see waitUntil
+        """
+        return self.waitUntil(lambda values: values[name] == value, timeout, cancel)
@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+"""
+Channel Access helpers shared by the cpiSync pcas drivers (indico100Sync.py, cmp200Sync.py).
+"""
+import sys, threading
+if '--sim' in sys.argv:
+    from syncSim import PV # same switch as the drivers
+else:
+    from epics import PV
+from syncDaq import LineState
+from syncClock import monotonic
+
+
+class PVRegistry(object):
+    """
+    One handle per PV name for the whole driver. add() only creates the channel and CA connects it in the
+    background, so all the PVs are searched for at once and waitConnected() waits for them against one
+    deadline instead of one connection timeout per PV in turn. Sequences keep the handles returned by
+    add() and use handle.get()/put() rather than caget/caput of a name (which looks the channel up every call).
+    """
+    def __init__(self):
+        self.pvs = {}
+        self.requested = {}                                 # name -> monotonic() when the channel was created
+        self.connected = {}                                 # name -> current connection state
+        self.latency = {}                                   # name -> seconds from creation to first connection
+        self.listeners = []
+        self.optional = set()                               # names waitConnected doesn't wait for
+        self.condition = threading.Condition()
+
+    def add(self, name, callback=None, optional=False):
+        """
+        Handle of a PV, created on first use. A callable callback is added as a monitor callback.
+        An optional PV (from an IOC that may not be running) is followed like the others but not waited for at startup
+        """
+        with self.condition:
+            if optional:
+                self.optional.add(name)
+            pv = self.pvs.get(name)
+            if pv is None:
+                self.requested[name] = monotonic()
+                self.connected.setdefault(name, False)
+                pv = PV(name, connection_callback=self.connection)
+                self.pvs[name] = pv
+        if callable(callback):
+            pv.add_callback(callback)
+        return pv
+
+    def names(self):
+        return sorted(self.pvs)
+
+    def onConnection(self, listener):
+        """
+        listener(name, connected, latency) is called on every connect and disconnect (on the CA thread)
+        """
+        self.listeners.append(listener)
+
+    def connection(self, pvname=None, conn=None, **kw):
+        with self.condition:
+            self.connected[pvname] = bool(conn)
+            if conn and pvname not in self.latency:
+                self.latency[pvname] = monotonic() - self.requested.get(pvname, monotonic())
+            self.condition.notify_all()
+        for listener in list(self.listeners):
+            listener(pvname, bool(conn), self.latency.get(pvname))
+
+    def missing(self):
+        """
+        Names of the PVs not connected right now
+        """
+        return [name for name in self.names() if not self.connected.get(name)]
+
+    def waitConnected(self, timeout):
+        """
+        Block until every PV that isn't optional is connected or timeout seconds pass,
+        returns the names still not connected
+        """
+        end = monotonic() + timeout
+        with self.condition:
+            while True:
+                missing = [name for name in self.missing() if name not in self.optional]
+                remaining = end - monotonic()
+                if not missing or remaining <= 0:
+                    return missing
+                self.condition.wait(remaining)
+
+    def status(self):
+        """
+        [(name, connected, first connection latency or None), ...] sorted by name
+        """
+        with self.condition:
+            return [(name, self.connected.get(name, False), self.latency.get(name)) for name in self.names()]
+
+
+# the registry shared by the driver and the helpers below
+PVS = PVRegistry()
+
+
+class PVSnapshot(object):
+    """
+    Pre-connected, monitored PVs whose latest values are cached by their monitor callbacks,
+    so reading all of them is a local read instead of one caget round trip per PV.
+    """
+    def __init__(self, names):
+        self.names = list(names)
+        self.values = dict((name, None) for name in self.names)
+        self.pvs = [PVS.add(name, self.update) for name in self.names]
+
+    def update(self, pvname=None, value=None, **kw):
+        self.values[pvname] = value
+
+    def snapshot(self):
+        """
+        Returns [(name, value), ...] in the order the names were given (None if never connected)
+        """
+        values = self.values.copy()
+        return [(name, values[name]) for name in self.names]
+
+
+class MonitoredPV(LineState):
+    """
+    PV whose monitor callback feeds a LineState, so a sequence can block until the PV reaches a value
+    instead of polling it with caget. waitFor/waitUntil/wake work as in LineState, keyed by the PV name.
+    """
+    def __init__(self, name):
+        super(MonitoredPV, self).__init__((name,))
+        self.name = name
+        self.values[name] = None
+        self.pv = PVS.add(name, self.monitor)
+
+    def monitor(self, pvname=None, value=None, **kw):
+        self.update({self.name: value})
+
+    def get(self):
+        return self.values[self.name]
+
+    def waitForValue(self, value, timeout=None, cancel=None):
+        """
+        Block until the PV equals value, returns False on timeout or cancel
+        """
+        return self.waitFor(self.name, value, timeout, cancel)
+
+
+class ScanState(PVSnapshot):
+    """
+    Always current view of the sscan progress records (CA monitors), so the per shot
+    "is this the last point" check and the abort "is a scan running" check are local reads.
+    scanRecord is the sscan record prefix (e.g. SCAN_IOC + 'scan1'), progress the scanProgress prefix.
+    """
+    def __init__(self, scanRecord, progress):
+        self.fields = {'Nfinished': progress + 'Nfinished',
+                       'Ntotal'   : progress + 'Ntotal',
+                       'running'  : progress + 'running',
+                       'CPT'      : scanRecord + '.CPT',
+                       'NPTS'     : scanRecord + '.NPTS',
+                       'P1PV'     : scanRecord + '.P1PV'}
+        super(ScanState, self).__init__(sorted(self.fields.values()))
+
+    def get(self, field):
+        """
+        Latest monitored value of a field ('Nfinished', 'Ntotal', 'running', 'CPT', 'NPTS', 'P1PV')
+        """
+        return self.values[self.fields[field]]
+
+    def isLastPoint(self):
+        """
+        True if the point being acquired now is the last one of the scan (scanProgress or, for 1D scans, scan1 counts)
+        """
+        values = self.values.copy()
+        nfinished, ntotal = values[self.fields['Nfinished']], values[self.fields['Ntotal']]
+        cpt, npts = values[self.fields['CPT']], values[self.fields['NPTS']]
+        return ((nfinished is not None and ntotal is not None and nfinished + 1 == ntotal) or
+                (cpt is not None and npts is not None and cpt + 1 == npts))
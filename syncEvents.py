@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+"""
+Binary log of every input line transition for the cpiSync pcas drivers (indico100Sync.py, cmp200Sync.py).
+Each edge is one EDGE_DTYPE record (sequence number, monotonic() timestamp, line index, direction),
+kept in a preallocated ring buffer and appended to <name>.bin in bulk by a JobQueue.
+<name>.json next to it holds the line names and a (time.time(), monotonic()) pair taken together when the log
+was opened, wall(header, t) converts a record time to time.time() seconds.
+
+Query a log after a scan:
+
+    python syncEvents.py edgeLogs/edges_20161012-101500 [--line EXPOSE_RBV] [--start t0] [--end t1] [--pulses] [--wall]
+"""
+import json, os, sys, threading, time
+import numpy as np
+from syncClock import monotonic
+
+EDGE_DTYPE = np.dtype([('seq', '<u8'), ('time', '<f8'), ('line', 'u1'), ('rising', 'u1')])
+
+
+class EdgeLog(object):
+    """
+    Ring buffer of edge records with one writer (the input backend) and no lock on its side: the writer fills a slot
+    and then advances self.count, a flush copies the slots between self.flushed and self.count.
+    Flushes hold self.lock, so a queued flush and a direct one at shutdown can't write the same records twice.
+    A flush is queued on jobs when half the buffer is waiting or flushInterval seconds have passed.
+    If the writer laps the flush the overwritten records are counted in self.overruns.
+    """
+    def __init__(self, basename, lines, jobs, capacity=65536, flushInterval=10.0):
+        self.basename = basename
+        self.lines = list(lines)
+        self.jobs = jobs
+        self.data = np.zeros((capacity,), dtype=EDGE_DTYPE)
+        self.count = 0                                      # records written
+        self.flushed = 0                                    # records written to disk (or lost)
+        self.queued = False
+        self.overruns = 0
+        self.flushInterval = flushInterval
+        self.lastFlushTime = monotonic()
+        self.lock = threading.Lock()
+        directory = os.path.dirname(basename)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(basename + '.json', 'w') as f:
+            json.dump({'lines': self.lines, 'dtype': EDGE_DTYPE.descr, 'wallTime': time.time(), 'monotonic': monotonic()}, f)
+
+    def record(self, changed, word, timestamp):
+        """
+        Log every set bit of changed (bit i = line i) with its new value from word
+        """
+        capacity = len(self.data)
+        line = 0
+        while changed:
+            if changed & 1:
+                self.data[self.count % capacity] = (self.count, timestamp, line, word >> line & 1)
+                self.count += 1
+            changed >>= 1
+            line += 1
+        if not self.queued and (self.count - self.flushed >= capacity // 2 or
+                                timestamp - self.lastFlushTime > self.flushInterval):
+            self.queueFlush()
+
+    def queueFlush(self):
+        if self.count > self.flushed:
+            self.queued = True
+            self.jobs.put(self.flush)
+        self.lastFlushTime = monotonic()
+
+    def flush(self):
+        """
+        Append the records not yet on disk to basename.bin (runs on the jobs thread)
+        """
+        with self.lock:
+            self.queued = False
+            capacity = len(self.data)
+            end = self.count
+            start = max(self.flushed, end - capacity)
+            self.overruns += start - self.flushed
+            if end == start:
+                return
+            first, last = start % capacity, end % capacity
+            if first < last:
+                chunk = self.data[first:last].copy()
+            else:
+                chunk = np.concatenate((self.data[first:], self.data[:last]))
+            # the writer may have lapped us while copying, drop anything it overwrote
+            lapped = self.count - capacity - start
+            if lapped > 0:
+                chunk = chunk[lapped:]
+                self.overruns += lapped
+            with open(self.basename + '.bin', 'ab') as f:
+                chunk.tofile(f)
+            self.flushed = end
+
+
+def load(basename):
+    """
+    Returns (line names, record array) of a log
+    """
+    return header(basename)['lines'], np.fromfile(basename + '.bin', dtype=EDGE_DTYPE)
+
+
+def header(basename):
+    """
+    Contents of the .json next to a log
+    """
+    with open(basename + '.json') as f:
+        return json.load(f)
+
+
+def wall(header, t):
+    """
+    time.time() seconds of a record time, logs written before the anchor was added have none (returns None)
+    """
+    if 'wallTime' not in header:
+        return None
+    return t - header['monotonic'] + header['wallTime']
+
+
+def query(lines, events, line=None, start=None, end=None):
+    """
+    Records of one line (name) between start and end (monotonic() of the driver), all by default
+    """
+    mask = np.ones(len(events), dtype=bool)
+    if line is not None:
+        mask &= events['line'] == lines.index(line)
+    if start is not None:
+        mask &= events['time'] >= start
+    if end is not None:
+        mask &= events['time'] <= end
+    return events[mask]
+
+
+def pulses(events):
+    """
+    (rise time, high duration) of every complete high pulse in the records of one line
+    """
+    result = []
+    riseTime = None
+    for event in events:
+        if event['rising']:
+            riseTime = event['time']
+        elif riseTime is not None:
+            result.append((riseTime, event['time'] - riseTime))
+            riseTime = None
+    return result
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Print a cpiSync edge log')
+    parser.add_argument('basename', help='log file name without .bin/.json')
+    parser.add_argument('--line', help='only this line (record name)')
+    parser.add_argument('--start', type=float, help='first timestamp')
+    parser.add_argument('--end', type=float, help='last timestamp')
+    parser.add_argument('--pulses', action='store_true', help='print high pulses (needs --line) instead of edges')
+    parser.add_argument('--wall', action='store_true', help='print edge times as time.time() seconds')
+    args = parser.parse_args()
+    lines, events = load(args.basename)
+    events = query(lines, events, args.line, args.start, args.end)
+    if args.wall:
+        offset = wall(header(args.basename), 0.0)
+        if offset is None:
+            sys.exit('this log has no wall clock anchor')
+        events['time'] += offset
+    if args.pulses:
+        if args.line is None:
+            sys.exit('--pulses needs --line')
+        for rise, duration in pulses(events):
+            print '%.6f %.6f' % (rise, duration)
+    else:
+        for event in events:
+            print '%8d %.6f %-20s %s' % (event['seq'], event['time'], lines[event['line']], 'rise' if event['rising'] else 'fall')
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+"""
+Background job helpers shared by the cpiSync pcas drivers (indico100Sync.py, cmp200Sync.py).
+"""
+import threading, time, Queue
+from syncClock import monotonic
+from syncLog import LOG
+
+
+class JobQueue(object):
+    """
+    Runs queued jobs in order on one long-lived background thread.
+    Used for work that must stay out of the exposure path (DAQ writes, file I/O).
+    """
+    def __init__(self, name='jobs'):
+        self.name = name
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self.run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, func, *args):
+        """
+        Queue func(*args) to run on the worker thread, returns immediately
+        """
+        self.queue.put((monotonic(), func, args))
+
+    def join(self):
+        """
+        Returns once every queued job has run
+        """
+        self.queue.join()
+
+    def jobDone(self, queueTime):
+        """
+        Called after each job with the time it was queued
+        """
+        pass
+
+    def run(self):
+        while True:
+            queueTime, func, args = self.queue.get()
+            try:
+                func(*args)
+            except Exception as e:
+                LOG.error('%s job error %s', self.name, e)
+            self.jobDone(queueTime)
+            self.queue.task_done()
+
+
+class TimerWheel(object):
+    """
+    Runs periodic callbacks on one background thread. Time is cut into ticks of tick seconds and each
+    callback sits in the slot of the tick it is next due (rounds counts the extra turns of the wheel for
+    periods longer than the wheel), so a tick only looks at one slot however many callbacks there are.
+    after() is called once after every tick that ran a callback (e.g. the driver's updatePVs).
+    """
+    def __init__(self, name='timers', tick=0.1, slots=64, after=None):
+        self.name = name
+        self.tick = tick
+        self.slots = [[] for i in range(slots)]
+        self.ticks = 0                                      # ticks run since start
+        self.after = after
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name=name)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def every(self, period, func, *args):
+        """
+        Call func(*args) every period seconds (rounded to whole ticks), first one period from now
+        """
+        ticks = max(1, int(round(period / self.tick)))
+        with self.lock:
+            self.insert([ticks, 0, func, args], ticks)
+
+    def insert(self, entry, delay):
+        # entry is [period in ticks, rounds left, func, args], delay in ticks from the current one
+        entry[1] = (delay - 1) // len(self.slots)
+        self.slots[(self.ticks + delay) % len(self.slots)].append(entry)
+
+    def advance(self):
+        """
+        Run one tick: the due callbacks of the current slot, then after()
+        """
+        with self.lock:
+            self.ticks += 1
+            index = self.ticks % len(self.slots)
+            due = [entry for entry in self.slots[index] if entry[1] == 0]
+            waiting = [entry for entry in self.slots[index] if entry[1] > 0]
+            for entry in waiting:
+                entry[1] -= 1
+            self.slots[index] = waiting
+            for entry in due:
+                self.insert(entry, entry[0])
+        for period, rounds, func, args in due:
+            try:
+                func(*args)
+            except Exception as e:
+                LOG.error('%s timer error %s', self.name, e)
+        if due and self.after is not None:
+            self.after()
+
+    def run(self):
+        nextTick = monotonic()
+        while True:
+            nextTick += self.tick
+            delay = nextTick - monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -10 * self.tick:                   # far behind (suspended), don't replay the missed ticks
+                nextTick = monotonic()
+            self.advance()
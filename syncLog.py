@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+Queue backed logger shared by the cpiSync pcas drivers (indico100Sync.py, cmp200Sync.py) and their helpers.
+The caller only takes a monotonic() timestamp and queues (time, level, format, args), the text is formatted
+and written on a background thread, so a slow consumer of the procServ pipe can't stall the poll thread.
+Messages below the logger level are dropped before anything is queued.
+
+    from syncLog import LOG
+    LOG.debug('Qi2 START EXPOSURE %.4f', timestamp - start)
+"""
+import sys, threading, Queue
+from syncClock import monotonic, stamp
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVEL_NAMES = ('DEBUG', 'INFO', 'WARNING', 'ERROR')         # order of the LOG_LEVEL enum records
+LEVELS = dict(zip(LEVEL_NAMES, (DEBUG, INFO, WARNING, ERROR)))
+
+
+class Logger(object):
+    """
+    Lines are '<stamp()> <message>' like the print statements they replace, warnings and errors
+    are prefixed with their level name
+    """
+    def __init__(self, level=DEBUG, stream=None):
+        self.level = level
+        self.stream = stream
+        self.queue = Queue.Queue()
+        self.thread = threading.Thread(target=self.run, name='logger')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def setLevel(self, level):
+        """
+        level is a number (DEBUG...) or a name ('DEBUG'...)
+        """
+        self.level = LEVELS.get(level, level)
+
+    def log(self, level, message, *args):
+        if level >= self.level:
+            self.queue.put((monotonic(), level, message, args))
+
+    def debug(self, message, *args):
+        if DEBUG >= self.level:
+            self.queue.put((monotonic(), DEBUG, message, args))
+
+    def info(self, message, *args):
+        if INFO >= self.level:
+            self.queue.put((monotonic(), INFO, message, args))
+
+    def warning(self, message, *args):
+        self.log(WARNING, message, *args)
+
+    def error(self, message, *args):
+        self.log(ERROR, message, *args)
+
+    def flush(self):
+        """
+        Returns once every queued message is written
+        """
+        self.queue.join()
+
+    def format(self, timestamp, level, message, args):
+        try:
+            text = message % args if args else str(message)
+        except (TypeError, ValueError):
+            text = ' '.join(str(x) for x in (message,) + args)
+        if level >= WARNING:
+            text = LEVEL_NAMES[min(level // 10 - 1, 3)] + ': ' + text
+        return stamp(timestamp) + ' ' + text + '\n'
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            stream = self.stream or sys.stdout
+            try:
+                stream.write(self.format(*record))
+                if self.queue.empty():
+                    stream.flush()
+            except Exception:
+                pass
+            self.queue.task_done()
+
+
+LOG = Logger()
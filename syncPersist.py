@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""
+Persistence helpers shared by the cpiSync pcas drivers (indico100Sync.py, cmp200Sync.py).
+"""
+import os, pickle, threading, atexit
+from syncLog import LOG
+
+
+class PersistentValue(object):
+    """
+    One pickled value kept in a file, written in the background.
+    set() only stores the value in memory and marks it dirty, a timer flushes it at most every
+    interval seconds and flush() is also registered with atexit. Writes go to a temp file that is
+    then renamed over the old one, so a crash never leaves a half written file behind.
+    """
+    def __init__(self, filename, interval=1.0):
+        self.filename = filename
+        self.interval = interval
+        self.value = None
+        self.dirty = False
+        self.timer = None
+        self.lock = threading.Lock()                        # value, dirty and timer, never held during file I/O
+        self.writeLock = threading.Lock()                   # one flush at a time
+        atexit.register(self.flush)
+
+    def load(self, default):
+        """
+        Returns the stored value, or default if the file is missing or unreadable
+        """
+        try:
+            with open(self.filename) as f:
+                self.value = pickle.load(f)
+        except Exception as e:
+            LOG.warning('Could not load %s %s', self.filename, e)
+            self.value = default
+        return self.value
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+            self.dirty = True
+            if self.timer is None:
+                self.timer = threading.Timer(self.interval, self.flush)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        """
+        Write the value now if it changed since the last write. Flushes (timer, atexit, direct calls)
+        run one at a time on writeLock, so they never share the temp file or publish an older value
+        """
+        with self.writeLock:
+            with self.lock:
+                if self.timer is not None:
+                    self.timer.cancel()
+                    self.timer = None
+                if not self.dirty:
+                    return
+                value = self.value
+                self.dirty = False
+            tmpname = self.filename + '.tmp'
+            try:
+                with open(tmpname, 'wb') as f:
+                    pickle.dump(value, f)
+                    f.flush()
+                    os.fsync(f.fileno())
+                try:
+                    os.rename(tmpname, self.filename)
+                except OSError:
+                    # Windows can't rename over an existing file
+                    os.remove(self.filename)
+                    os.rename(tmpname, self.filename)
+            except Exception as e:
+                LOG.error('Could not save %s %s', self.filename, e)
+                with self.lock:
+                    self.dirty = True
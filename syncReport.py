@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+"""
+End of scan timing reports for the cpiSync pcas drivers (indico100Sync.py, cmp200Sync.py).
+The sequence takes a ScanReport snapshot (cheap, no I/O) and hands it to a JobQueue,
+which writes one file per format in REPORT_WRITERS.
+"""
+import csv, json
+from syncLog import LOG
+
+# statistics lines of the text report: (label, timing record)
+TEXT_STATS = (('qi2 duration num mean stddev min max ', 'Qi2Duration'),
+              ('cpi duration num mean stddev min max  ', 'CpiDuration'),
+              ('dutycycle num mean stddev min max  ', 'DutyCycle'),
+              ('single shot length num mean stddev min max  ', 'ShotDuration'))
+STAT_NAMES = ('count', 'mean', 'std', 'min', 'max')
+
+
+class ScanReport(object):
+    """
+    Copy of the scan summary and the timing buffers, taken when the scan ends so the buffers
+    can be reset right away and the report written later on another thread.
+    summary is a list of (label, value) pairs, timingStats maps timing record -> TimingBuffer
+    """
+    def __init__(self, title, summary, timingStats):
+        self.title = title
+        self.summary = list(summary)
+        self.stats = dict((reason, buf.stats()) for reason, buf in timingStats.items())
+        self.values = dict((reason, buf.last(buf.count)) for reason, buf in timingStats.items())
+
+
+def writeText(report, filename):
+    with open(filename, 'w+') as f:
+        f.write(report.title + '\n')
+        for label, value in report.summary:
+            f.write(label + ' ' + str(value) + '\n')
+        for label, reason in TEXT_STATS:
+            f.write(label + ' '.join(str(x) for x in report.stats[reason]) + '\n')
+
+
+def writeCsv(report, filename):
+    """
+    One row per timing record: record, count, mean, std, min, max
+    """
+    with open(filename, 'wb') as f:
+        writer = csv.writer(f)
+        writer.writerow(('record',) + STAT_NAMES)
+        for reason in sorted(report.stats):
+            writer.writerow((reason,) + tuple(report.stats[reason]))
+
+
+def writeJson(report, filename):
+    """
+    Summary, statistics and every per shot (time, value) pair
+    """
+    doc = {'title'  : report.title,
+           'summary': [[label, value] for label, value in report.summary],
+           'stats'  : dict((reason, dict(zip(STAT_NAMES, stats))) for reason, stats in report.stats.items()),
+           'shots'  : dict((reason, {'time': data['time'].tolist(), 'value': data['value'].tolist()})
+                           for reason, data in report.values.items())}
+    with open(filename, 'w') as f:
+        json.dump(doc, f, indent=1)
+
+
+# file extension -> writer, add an entry here for a new report format
+REPORT_WRITERS = {'txt' : writeText,
+                  'csv' : writeCsv,
+                  'json': writeJson}
+
+
+def writeReport(report, basename, formats):
+    """
+    Writes basename.<ext> for each format, errors in one format don't stop the others
+    """
+    for ext in formats:
+        try:
+            REPORT_WRITERS[ext](report, basename + '.' + ext)
+        except Exception as e:
+            LOG.error('Error writing %s timing report %s', ext, e)
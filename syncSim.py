@@ -0,0 +1,378 @@
+#!/usr/bin/env python
+"""
+Hardware free stand-in for the PyDAQmx calls used by the cpiSync pcas drivers (indico100Sync.py, cmp200Sync.py),
+with models of the CPI generator and the Qi2 camera wired to the simulated lines, and in-process
+stand-ins for the pyepics PV/caget/caput the drivers use. The drivers import it in place of PyDAQmx
+and epics when started with --sim:
+
+    if '--sim' in sys.argv: from syncSim import *
+    else:                   from PyDAQmx import *; from epics import *
+
+Only the subset of DAQmx the drivers use is implemented (digital line tasks, reads, writes, change detection).
+Latencies are in seconds. Jitter is uniform +-jitter drawn from a seeded random.Random, so with the same
+seed and the same sequence of writes a run is repeatable.
+"""
+import ctypes, heapq, itertools, random, threading, time
+import numpy
+from syncClock import monotonic
+
+__all__ = ['numpy', 'PV', 'caget', 'caput', 'TaskHandle', 'int32', 'byref', 'DEVICE', 'CpiModel', 'Qi2Model',
+           'DAQmx_Val_ChanForAllLines', 'DAQmx_Val_ActiveDrive', 'DAQmx_Val_GroupByChannel',
+           'DAQmx_Val_ContSamps', 'DAQmx_Val_ChangeDetectionEvent',
+           'DAQmxCreateTask', 'DAQmxCreateDOChan', 'DAQmxCreateDIChan', 'DAQmxSetDOOutputDriveType',
+           'DAQmxStartTask', 'DAQmxStopTask', 'DAQmxClearTask', 'DAQmxWriteDigitalLines', 'DAQmxReadDigitalLines',
+           'DAQmxCfgChangeDetectionTiming', 'DAQmxRegisterSignalEvent', 'DAQmxSignalEventCallbackPtr']
+
+# same values as NIDAQmx.h
+DAQmx_Val_ChanForAllLines      = 1
+DAQmx_Val_ActiveDrive          = 12573
+DAQmx_Val_GroupByChannel       = 0
+DAQmx_Val_ContSamps            = 10123
+DAQmx_Val_ChangeDetectionEvent = 12511
+
+# default model timing, override with keyword arguments to CpiModel/Qi2Model
+CPI_TIMING = {'prepTime'      : 2.0,    # RAD_PREP in to RAD_READY out
+              'statusDelay'   : 0.05,   # EXPOSE in to generator exposure status (serial)
+              'exposeLatency' : 0.007,  # PHOTOSPOT in (or EXPOSE in without photospot) to EXPOSE out
+              'exposeTime'    : 0.1,    # length of the EXPOSE out pulse
+              'jitter'        : 0.001}
+QI2_TIMING = {'triggerLatency': 0.0005, # trigger in to EXPOSING out
+              'exposeTime'    : 0.1,    # length of the EXPOSING out pulse
+              'readoutTime'   : 0.03,   # end of exposure to TRIGGER_READY out
+              'jitter'        : 0.0005}
+
+
+class SimDevice(object):
+    """
+    The simulated DAQ: current value of every physical line, watchers called when a line changes,
+    and one scheduler thread that runs the models' delayed events in time order.
+    readTime is how long DAQmxReadDigitalLines blocks, like a USB-6501 read.
+    """
+    def __init__(self, seed=0, readTime=0.001):
+        self.lines = {}
+        self.watchers = []
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+        self.readTime = readTime
+        self.events = []
+        self.counter = itertools.count()
+        self.wakeup = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name='simDaq')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def seed(self, seed):
+        self.random.seed(seed)
+
+    def get(self, line):
+        return self.lines.get(line, 0)
+
+    def set(self, line, value):
+        """
+        Drive a line, watchers of that line are called (on this thread) if the value changed
+        """
+        with self.lock:
+            if self.lines.get(line, 0) == value:
+                return
+            self.lines[line] = value
+            watchers = [func for lines, func in self.watchers if line in lines]
+        for func in watchers:
+            func(line, value)
+
+    def watch(self, lines, func):
+        """
+        Call func(line, value) whenever one of lines changes
+        """
+        with self.lock:
+            self.watchers.append((set(lines), func))
+
+    def jitter(self, value, jitter):
+        return max(0.0, value + self.random.uniform(-jitter, jitter))
+
+    def after(self, delay, func, *args):
+        """
+        Run func(*args) on the scheduler thread delay seconds from now
+        """
+        with self.wakeup:
+            heapq.heappush(self.events, (monotonic() + delay, next(self.counter), func, args))
+            self.wakeup.notify()
+
+    def run(self):
+        while True:
+            with self.wakeup:
+                while not self.events:
+                    self.wakeup.wait()
+                when, n, func, args = self.events[0]
+                wait = when - monotonic()
+                if wait <= 0:
+                    heapq.heappop(self.events)
+            if wait <= 0:
+                func(*args)
+            else:
+                # py2 time.sleep raises on a negative argument
+                time.sleep(max(0.0, min(wait, 0.0005)))
+
+
+DEVICE = SimDevice()
+
+
+class SimTask(ctypes.c_void_p):
+    """
+    A DAQmx task: the lines of its channels, in the order they were added.
+    A ctypes handle like PyDAQmx's TaskHandle, so it is unhashable there too (no task keyed dicts)
+    """
+    def __init__(self):
+        super(SimTask, self).__init__()
+        self.lines = []
+        self.changeLines = None
+        self.running = False
+
+
+class int32(object):
+    def __init__(self, value=0):
+        self.value = value
+
+
+TaskHandle = SimTask
+
+
+def byref(obj):
+    return obj
+
+
+def splitLines(lines):
+    return [line.strip() for line in lines.split(',') if line.strip()]
+
+
+def DAQmxCreateTask(name, task):
+    return 0
+
+
+def DAQmxCreateDOChan(task, lines, nameToAssign, lineGrouping):
+    task.lines.extend(splitLines(lines))
+    return 0
+
+
+def DAQmxCreateDIChan(task, lines, nameToAssign, lineGrouping):
+    task.lines.extend(splitLines(lines))
+    return 0
+
+
+def DAQmxSetDOOutputDriveType(task, channel, data):
+    return 0
+
+
+def DAQmxStartTask(task):
+    task.running = True
+    return 0
+
+
+def DAQmxStopTask(task):
+    task.running = False
+    return 0
+
+
+def DAQmxClearTask(task):
+    task.running = False
+    return 0
+
+
+def DAQmxWriteDigitalLines(task, numSampsPerChan, autoStart, timeout, dataLayout, writeArray, sampsPerChanWritten, reserved):
+    for line, value in zip(task.lines, writeArray):
+        DEVICE.set(line, 1 if value else 0)
+    if sampsPerChanWritten is not None:
+        sampsPerChanWritten.value = numSampsPerChan
+    return 0
+
+
+def DAQmxReadDigitalLines(task, numSampsPerChan, timeout, fillMode, readArray, arraySizeInBytes, sampsPerChanRead, numBytesPerSamp, reserved):
+    if DEVICE.readTime:
+        time.sleep(DEVICE.readTime)
+    for i, line in enumerate(task.lines[:arraySizeInBytes]):
+        readArray[i] = DEVICE.get(line)
+    return 0
+
+
+def DAQmxCfgChangeDetectionTiming(task, risingEdgeChan, fallingEdgeChan, sampleMode, sampsPerChan):
+    task.changeLines = set(splitLines(risingEdgeChan)) | set(splitLines(fallingEdgeChan))
+    return 0
+
+
+def DAQmxRegisterSignalEvent(task, signalID, options, callbackFunction, callbackData):
+    def changed(line, value):
+        if task.running:
+            callbackFunction(task, signalID, callbackData)
+    DEVICE.watch(task.changeLines or task.lines, changed)
+    return 0
+
+
+def DAQmxSignalEventCallbackPtr(func):
+    return func
+
+
+class CpiModel(object):
+    """
+    CPI generator: RAD_PREP in -> RAD_PREP out, RAD_READY out after prepTime. With RAD_READY, EXPOSE in
+    moves the generator to the exposure status (statusDelay) and fires the exposure, or only arms it
+    if there is a photospot line, in which case PHOTOSPOT in fires it. An exposure is EXPOSE out high
+    for exposeTime, starting exposeLatency after the request.
+    Functions passed to onStatus are called with the generator status (GENERATOR_EXPOSURE when armed).
+    """
+    GENERATOR_IDLE = 0
+    GENERATOR_EXPOSURE = 4
+
+    def __init__(self, device, radPrepIn, exposeIn, radPrepOut, radReadyOut, exposeOut, photospotIn=None, **timing):
+        self.device = device
+        self.radPrepIn, self.exposeIn, self.photospotIn = radPrepIn, exposeIn, photospotIn
+        self.radPrepOut, self.radReadyOut, self.exposeOut = radPrepOut, radReadyOut, exposeOut
+        self.timing = dict(CPI_TIMING)
+        self.timing.update(timing)
+        self.status = self.GENERATOR_IDLE
+        self.statusCallbacks = []
+        self.exposing = False
+        device.watch([line for line in (radPrepIn, exposeIn, photospotIn) if line is not None], self.changed)
+
+    def onStatus(self, func):
+        self.statusCallbacks.append(func)
+        func(self.status)
+
+    def setStatus(self, status):
+        if status != self.status:
+            self.status = status
+            for func in self.statusCallbacks:
+                func(status)
+
+    def delay(self, name):
+        return self.device.jitter(self.timing[name], self.timing['jitter'])
+
+    def changed(self, line, value):
+        if line == self.radPrepIn:
+            if value:
+                self.device.set(self.radPrepOut, 1)
+                self.device.after(self.delay('prepTime'), self.ready)
+            else:
+                self.device.set(self.radReadyOut, 0)
+                self.device.set(self.radPrepOut, 0)
+                self.setStatus(self.GENERATOR_IDLE)
+        elif line == self.exposeIn:
+            if value and self.device.get(self.radReadyOut):
+                self.device.after(self.delay('statusDelay'), self.armed)
+            elif not value:
+                self.setStatus(self.GENERATOR_IDLE)
+        self.checkFire()
+
+    def ready(self):
+        if self.device.get(self.radPrepIn):
+            self.device.set(self.radReadyOut, 1)
+            if self.device.get(self.exposeIn):
+                self.device.after(self.delay('statusDelay'), self.armed)
+            self.checkFire()
+
+    def armed(self):
+        if self.device.get(self.exposeIn) and self.device.get(self.radReadyOut):
+            self.setStatus(self.GENERATOR_EXPOSURE)
+
+    def checkFire(self):
+        get = self.device.get
+        if (not self.exposing and get(self.radReadyOut) and get(self.exposeIn) and
+                (self.photospotIn is None or get(self.photospotIn))):
+            self.exposing = True
+            self.device.after(self.delay('exposeLatency'), self.exposeStart)
+
+    def exposeStart(self):
+        self.device.set(self.exposeOut, 1)
+        self.device.after(self.delay('exposeTime'), self.exposeEnd)
+
+    def exposeEnd(self):
+        self.device.set(self.exposeOut, 0)
+        self.exposing = False
+
+
+class Qi2Model(object):
+    """
+    Qi2 camera in hardware trigger mode: TRIGGER_READY out is high while idle, a rising trigger in starts
+    an exposure (EXPOSING out high for exposeTime, triggerLatency later), TRIGGER_READY returns readoutTime
+    after the exposure ends.
+    """
+    def __init__(self, device, triggerIn, triggerReadyOut, exposingOut, **timing):
+        self.device = device
+        self.triggerIn, self.triggerReadyOut, self.exposingOut = triggerIn, triggerReadyOut, exposingOut
+        self.timing = dict(QI2_TIMING)
+        self.timing.update(timing)
+        device.set(triggerReadyOut, 1)
+        device.watch([triggerIn], self.changed)
+
+    def delay(self, name):
+        return self.device.jitter(self.timing[name], self.timing['jitter'])
+
+    def changed(self, line, value):
+        if value and self.device.get(self.triggerReadyOut):
+            self.device.set(self.triggerReadyOut, 0)
+            self.device.after(self.delay('triggerLatency'), self.exposeStart)
+
+    def exposeStart(self):
+        self.device.set(self.exposingOut, 1)
+        self.device.after(self.delay('exposeTime'), self.exposeEnd)
+
+    def exposeEnd(self):
+        self.device.set(self.exposingOut, 0)
+        self.device.after(self.delay('readoutTime'), self.ready)
+
+    def ready(self):
+        self.device.set(self.triggerReadyOut, 1)
+
+
+class PV(object):
+    """
+    In-process stand-in for epics.PV. There is one shared value per name (see caget/caput), monitor callbacks
+    get the pyepics keywords (pvname, value, char_value) on every put, and a callback added to a PV
+    that already has a value is called right away, like the first monitor after a connection.
+    """
+    registry = {}
+    lock = threading.Lock()
+    connected = True
+
+    def __new__(cls, pvname, callback=None, **kw):
+        with cls.lock:
+            pv = cls.registry.get(pvname)
+            if pv is None:
+                pv = object.__new__(cls)
+                pv.pvname = pvname
+                pv.value = None
+                pv.callbacks = []
+                cls.registry[pvname] = pv
+        if callable(callback):
+            pv.add_callback(callback)
+        connection = kw.get('connection_callback')
+        if callable(connection):                            # always connected
+            connection(pvname=pvname, conn=True, pv=pv)
+        return pv
+
+    def __init__(self, pvname, callback=None, **kw):
+        pass
+
+    @property
+    def char_value(self):
+        return None if self.value is None else str(self.value)
+
+    def get(self, **kw):
+        return self.value
+
+    def put(self, value, wait=False, **kw):
+        self.value = value
+        for callback in list(self.callbacks):
+            callback(pvname=self.pvname, value=value, char_value=self.char_value)
+
+    def add_callback(self, callback=None, **kw):
+        self.callbacks.append(callback)
+        if self.value is not None:
+            callback(pvname=self.pvname, value=self.value, char_value=self.char_value)
+
+
+def caget(pvname, **kw):
+    return PV(pvname).get()
+
+
+def caput(pvname, value, wait=False, **kw):
+    PV(pvname).put(value, wait)
+    return 1
@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+"""
+Timing helpers shared by the cpiSync pcas drivers (indico100Sync.py, cmp200Sync.py).
+"""
+import math, threading, time
+import numpy as np
+from syncClock import monotonic
+
+
+class LogHistogram(object):
+    """
+    Histogram with logarithmically spaced buckets, used for latency measurements (seconds).
+    Bucket 0 counts values below minValue, the last bucket counts values above maxValue.
+    """
+    def __init__(self, minValue=1e-5, maxValue=1.0, bucketsPerDecade=4):
+        self.minValue = minValue
+        self.bucketsPerDecade = bucketsPerDecade
+        decades = int(math.ceil(math.log10(maxValue / minValue)))
+        # upper edge of every bucket except the overflow bucket
+        self.edges = [minValue * 10 ** (float(i) / bucketsPerDecade) for i in range(decades * bucketsPerDecade + 1)]
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counts = [0] * (len(self.edges) + 1)
+            self.total = 0
+            self.maxValue = 0.0
+
+    def bucket(self, value):
+        """
+        Index of the bucket that value falls into
+        """
+        if value < self.minValue:
+            return 0
+        index = int(math.log10(value / self.minValue) * self.bucketsPerDecade) + 1
+        return min(index, len(self.counts) - 1)
+
+    def add(self, value):
+        index = self.bucket(value)
+        with self.lock:
+            self.counts[index] += 1
+            self.total += 1
+            if value > self.maxValue:
+                self.maxValue = value
+
+    def percentile(self, p):
+        """
+        Upper edge of the bucket holding the p-th percentile (maxValue for the overflow bucket), 0 if empty
+        """
+        with self.lock:
+            counts, total, maxValue = list(self.counts), self.total, self.maxValue
+        if total == 0:
+            return 0.0
+        rank = p / 100.0 * total
+        seen = 0
+        for index, count in enumerate(counts):
+            seen += count
+            if count and seen >= rank:
+                return min(self.edges[index], maxValue) if index < len(self.edges) else maxValue
+        return maxValue
+
+
+class LoopProfiler(object):
+    """
+    Log bucketed histograms of a polling loop: period (start to start), DAQ read time and publish
+    (processing) time. Each pass calls record() with three monotonic() stamps.
+    """
+    PARTS = ('period', 'read', 'publish')
+
+    def __init__(self):
+        self.histograms = dict((part, LogHistogram()) for part in self.PARTS)
+        self.lastStart = None
+
+    def reset(self):
+        for histogram in self.histograms.values():
+            histogram.reset()
+        self.lastStart = None
+
+    def record(self, start, readEnd, end):
+        if self.lastStart is not None:
+            self.histograms['period'].add(start - self.lastStart)
+        self.lastStart = start
+        self.histograms['read'].add(readEnd - start)
+        self.histograms['publish'].add(end - readEnd)
+
+    def summary(self, part):
+        """
+        Returns (p50, p99, max) of one part
+        """
+        histogram = self.histograms[part]
+        return histogram.percentile(50), histogram.percentile(99), histogram.maxValue
+
+    def dump(self):
+        """
+        Text table of every bucket: lower edge, then the count of each part
+        """
+        edges = [0.0] + self.histograms['period'].edges
+        lines = ['%12s' % 'bucket (s)' + ''.join('%10s' % part for part in self.PARTS)]
+        for index, edge in enumerate(edges):
+            lines.append('%12.6f' % edge + ''.join('%10d' % self.histograms[part].counts[index] for part in self.PARTS))
+        return '\n'.join(lines)
+
+
+class DelayScheduler(object):
+    """
+    Precise delays measured from a start time: sleep while far from the deadline, then spin the last
+    spinTime seconds. time.sleep alone overshoots by up to one OS timer tick (~15 ms on Windows).
+    The spin calls time.sleep(0) on each pass so the poll thread still gets the GIL.
+    """
+    def __init__(self, spinTime=0.003):
+        self.spinTime = spinTime
+        self.requested = 0.0
+        self.achieved = 0.0
+
+    def waitUntil(self, deadline):
+        """
+        Returns at (or just after) monotonic() deadline, returns the time it woke up
+        """
+        remaining = deadline - monotonic()
+        if remaining > self.spinTime:
+            time.sleep(remaining - self.spinTime)
+        now = monotonic()
+        while now < deadline:
+            time.sleep(0)
+            now = monotonic()
+        return now
+
+    def delay(self, delay, start=None):
+        """
+        Wait until delay seconds after start (monotonic(), default now), returns the achieved delay
+        """
+        if start is None:
+            start = monotonic()
+        self.requested = delay
+        self.achieved = self.waitUntil(start + delay) - start
+        return self.achieved
+
+
+class FramePLL(object):
+    """
+    Software phase locked loop on a periodic edge (the Qi2 frame starts on EXPOSING_RBV). edge() compares each
+    edge with the predicted frame start, and moves the phase (gain) and the period (periodGain) of the next
+    prediction by part of the error. Edges that skip frames are matched to the nearest predicted frame and
+    counted in missedEdges. Locked after lockCount edges in a row within tolerance seconds of the prediction.
+    After lockCount edges in a row more than 5 * tolerance out it starts over from two fresh edges.
+    The prediction is one tuple (frame index, start, period), so another thread can read it without a lock.
+    """
+    def __init__(self, gain=0.3, periodGain=0.05, tolerance=0.002, lockCount=4):
+        self.gain = gain
+        self.periodGain = periodGain
+        self.tolerance = tolerance
+        self.lockCount = lockCount
+        self.reset()
+
+    def reset(self):
+        self.prediction = None                              # (index, start time, period) of the next frame
+        self.lastEdge = None
+        self.locked = False
+        self.phaseError = 0.0
+        self.missedEdges = 0
+        self.good = 0                                       # edges in a row within tolerance
+        self.bad = 0                                        # edges in a row far out
+
+    def edge(self, t):
+        """
+        Feed a frame start timestamp (monotonic()), returns its phase error (None while acquiring)
+        """
+        prediction = self.prediction
+        if prediction is None:
+            if self.lastEdge is not None and t > self.lastEdge:
+                period = t - self.lastEdge
+                self.prediction = (1, t + period, period)
+            self.lastEdge = t
+            return None
+        index, start, period = prediction
+        skipped = max(0, int(round((t - start) / period)))
+        expected = start + skipped * period
+        error = t - expected
+        self.phaseError = error
+        self.missedEdges += skipped
+        if abs(error) <= self.tolerance:
+            self.good += 1
+            self.bad = 0
+        else:
+            self.good = 0
+            self.bad = self.bad + 1 if abs(error) > 5 * self.tolerance else 0
+        self.locked = self.good >= self.lockCount
+        if self.bad >= self.lockCount:
+            self.prediction, self.lastEdge, self.bad = None, t, 0
+            return error
+        period += self.periodGain * error / (skipped + 1)
+        self.prediction = (index + skipped + 1, expected + self.gain * error + period, period)
+        return error
+
+    def frameAfter(self, t):
+        """
+        (index, predicted start, period) of the first frame starting at or after t, None while acquiring
+        """
+        prediction = self.prediction
+        if prediction is None:
+            return None
+        index, start, period = prediction
+        ahead = max(0, int(math.ceil((t - start) / period)))
+        return index + ahead, start + ahead * period, period
+
+    @property
+    def period(self):
+        prediction = self.prediction
+        return prediction[2] if prediction is not None else 0.0
+
+
+class LatencyModel(object):
+    """
+    Running photospot to expose latency per generator setting (any hashable key, e.g. (kVp, mA, focus)):
+    count, mean and variance (Welford) of every observation. The count is capped at memory, so old shots
+    fade out and the estimate follows a slow drift of the generator. state() is a plain dict for pickling,
+    and a new model continues from it. Observations outside (0, maxLatency) are dropped as unrelated edges.
+    """
+    def __init__(self, state=None, memory=200, maxLatency=0.2):
+        self.stats = dict(state or {})                      # key -> (count, mean, m2)
+        self.memory = memory
+        self.maxLatency = maxLatency
+        self.last = 0.0
+        self.changed = False
+
+    def add(self, key, latency):
+        if not 0 < latency < self.maxLatency:
+            return
+        count, mean, m2 = self.stats.get(key, (0, 0.0, 0.0))
+        if count >= self.memory:
+            m2 *= (count - 1.0) / count
+            count -= 1
+        count += 1
+        delta = latency - mean
+        mean += delta / count
+        m2 += delta * (latency - mean)
+        self.stats[key] = (count, mean, m2)
+        self.last = latency
+        self.changed = True
+
+    def estimate(self, key):
+        """
+        (count, mean, std) of one setting, pooled over all settings if it has no observations yet
+        (the pooled m2 adds the spread of the setting means around the pooled mean to the settings' own m2)
+        """
+        stats = self.stats.get(key)
+        if stats is None:
+            values = list(self.stats.values())
+            count = sum(s[0] for s in values)
+            if count == 0:
+                return 0, 0.0, 0.0
+            mean = sum(s[0] * s[1] for s in values) / count
+            stats = (count, mean, sum(s[2] + s[0] * (s[1] - mean) ** 2 for s in values))
+        count, mean, m2 = stats
+        return count, mean, math.sqrt(m2 / (count - 1)) if count > 1 else 0.0
+
+    def predict(self, key, default):
+        """
+        Expected latency of a setting, default if nothing was observed yet
+        """
+        count, mean, std = self.estimate(key)
+        return mean if count else default
+
+    def state(self):
+        return dict(self.stats)
+
+
+class TimingBuffer(object):
+    """
+    Fixed capacity ring buffer for one timing metric, a numpy structured array of (time, value) pairs.
+    Keeps a running count/mean/std/min/max (Welford) over every value added since the last reset,
+    so the statistics are available at any time without touching the buffer.
+    """
+    def __init__(self, capacity=16384):
+        self.data = np.zeros((capacity,), dtype=[('time', 'f8'), ('value', 'f8')])
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.index = 0                                  # total number of values written
+            self.count = 0
+            self.mean = 0.0
+            self.m2 = 0.0
+            self.min = float('inf')
+            self.max = float('-inf')
+
+    def add(self, value, timestamp=None):
+        if timestamp is None:
+            timestamp = monotonic()
+        with self.lock:
+            self.data[self.index % len(self.data)] = (timestamp, value)
+            self.index += 1
+            self.count += 1
+            delta = value - self.mean
+            self.mean += delta / self.count
+            self.m2 += delta * (value - self.mean)
+            if value < self.min:
+                self.min = value
+            if value > self.max:
+                self.max = value
+
+    def std(self):
+        """
+        Population standard deviation (same as np.nanstd of all the values)
+        """
+        if self.count == 0:
+            return 0.0
+        return math.sqrt(self.m2 / self.count)
+
+    def stats(self):
+        """
+        Returns (count, mean, std, min, max)
+        """
+        with self.lock:
+            return self.count, self.mean, self.std(), self.min, self.max
+
+    def last(self, n):
+        """
+        Most recent n entries (oldest first), fewer if not that many were added
+        """
+        with self.lock:
+            n = min(n, self.index, len(self.data))
+            end = self.index % len(self.data)
+            if n <= end:
+                return self.data[end - n:end].copy()
+            return np.concatenate((self.data[len(self.data) - (n - end):], self.data[:end]))
+
+    def windowStats(self, n):
+        """
+        Returns (mean, std, min, max) of the most recent n values, zeros if nothing was added
+        """
+        values = self.last(n)['value']
+        if len(values) == 0:
+            return 0.0, 0.0, 0.0, 0.0
+        return float(values.mean()), float(values.std()), float(values.min()), float(values.max())